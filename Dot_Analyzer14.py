@@ -22,8 +22,11 @@
 #@ String vorodiagram (label="Choose the diagram to display ", choices={"Voronoi Diagram", "Voronoi/Delaunay Diagram"}, style="radioButtonHorizontal", value = choices[1],persist=False)
 #@ Boolean ripleygraph (label="Besag's L Function ", value = True, persist=true) 
 #@ Boolean pcfgraph (label="Pair Correlation Function ", value = True, persist=true) 
+#@ Integer envelopes (label="CSR envelopes of L(r) and g(r): simulations (0 = none) ", value=0, min=0, persist=true) 
 #@ Boolean ocfgraph (label="Bond-Orientational Correlation Function ", value = True, persist=true) 
 #@ Boolean SaveSpacing (label="Save Spacing and Order in a table ", value = True, persist=true) 
+#@ Boolean useCache (label="Reuse the cached analysis of the image ", value = True, persist=true) 
+#@ File paramFile (label="Batch parameter file (no dialog) ", style="file", required=False, persist=false)
 
 #@ DatasetIOService io
 #@ UIService uiService
@@ -40,20 +43,35 @@ from ij.plugin.frame import RoiManager, ThresholdAdjuster
 from ij.measure import ResultsTable , Measurements, Calibration, CurveFitter
 from ij.plugin.filter import Analyzer,  BackgroundSubtracter
 from ij.plugin.filter import ParticleAnalyzer as PA
-from ij.process import ImageProcessor, ImageConverter, ColorProcessor, ByteProcessor
+from ij.plugin.filter import MaximumFinder
+from ij.process import ImageProcessor, ImageConverter, ColorProcessor, ByteProcessor, FloatPolygon, Blitter
 
 
 import os
 from os import path
+import glob
+import jarray
+from array import array
+import hashlib
+import random
+import tempfile
+import shutil
+import csv
+from StringIO import StringIO
+import cPickle as pickle
 
 # Java class ---------------------------------------------------------------------------------------
-from java.io import File
-from java.lang import Double, Integer, Short, Thread, String, InterruptedException
-from java.awt import Color, Font, BasicStroke, Frame, BorderLayout, FlowLayout
+from java.io import File, FileInputStream, RandomAccessFile
+from java.lang import Double, Integer, Long, Short, Thread, String, InterruptedException, Runtime, Throwable, System
+from java.util.concurrent import Executors, Callable, TimeUnit, ConcurrentHashMap
+from java.util.concurrent.atomic import AtomicBoolean, AtomicLong
+from java.util.concurrent.locks import ReentrantLock
+from java.lang.management import ManagementFactory
+from java.awt import Color, Font, BasicStroke, Frame, BorderLayout, FlowLayout, Rectangle
 from java.text import NumberFormat, DecimalFormat, SimpleDateFormat, DecimalFormatSymbols
-from java.util import Locale, Date, Calendar, TimeZone, Iterator, Vector
+from java.util import Locale, Date, Calendar, TimeZone, Iterator, Vector, Properties, ArrayList
 from java.awt.image import BufferedImage, IndexColorModel
-from java.awt.geom import Rectangle2D, Ellipse2D
+from java.awt.geom import Rectangle2D, Ellipse2D, Path2D, AffineTransform
 
 from org.jfree.chart import ChartPanel, JFreeChart
 from org.jfree.chart.axis import NumberAxis
@@ -67,7 +85,14 @@ from javax.swing.GroupLayout import Alignment
 from javax.swing.LayoutStyle import ComponentPlacement
 
 
-from math import sqrt, atan2, cos, sin, pi, acos, log, exp, floor, isnan
+from math import sqrt, atan2, cos, sin, pi, acos, log, exp, floor, ceil, isnan
+from bisect import bisect_left, bisect_right
+
+# Bio-Formats (optional): read only a region of the image file in the tiled mode
+try :
+	from loci.plugins.util import ImageProcessorReader
+except ImportError :
+	ImageProcessorReader = None
 #---------------------------------------------------------------------------------------------------------
 
 #---------------------------------------------------------------
@@ -101,6 +126,62 @@ delaunayColor = 118
 
 voronoi = (vorodiagram == "Voronoi Diagram")
 
+# analysis cache (folder "cache" of Analyzed_<filename>): maximal number of entries and size in bytes (the least recently
+# used entries are evicted), version of the cached data (included in the keys). The entries are read with pickle: the
+# cache folders must be trusted (written by this script only)
+cacheMaxEntries = 8
+cacheMaxBytes = 512*1024*1024
+cacheVersion = 3
+
+# range of the CSR envelopes of the Besag's L and pair correlation functions, in mean dot spacings sqrt(area/N)
+envelopeRange = 10
+
+# print the record of each stage of the analysis (wall/CPU time, heap, ...) in the Log window
+logStages = False
+
+# number of workers of the per-dot loops (neighbor search, spacing/psi6, correlation functions)
+loopThreads = Runtime.getRuntime().availableProcessors()
+
+# format of the saved images (Voronoi/Delaunay image, calibration bar, plots): "tiff", "zip" (TIFF compressed in a ZIP
+# archive, lossless) or "png"
+outputFormats = {"tiff": "TIFF", "zip": "ZIP", "png": "PNG"}
+outputFormat = "tiff"
+
+# largest side in pixels of the Voronoi/Delaunay image in the tiled mode: the diagram of a larger image is drawn shrunk
+# by an integer factor, so that its memory does not grow with the image (0 = full resolution)
+diagramSize = 4096
+
+# approximate correlation functions from reference dots (see samplingBudget): number of reference dots (0 = exact
+# curves), time budget in seconds and target relative half-width of the 95% band (0 = no limit); groups of reference
+# dots and bootstrap resamples of the band
+sampleDots = 0
+sampleSeconds = 0
+sampleError = 0
+sampleGroups = 32
+bootstrapResamples = 200
+
+# background correction of the preprocessing (see correctBackground): "rolling" (rolling ball, reference), "rows" (rolling
+# ball on stripes of rows in parallel), "downsampled" (rolling ball on the image shrunk by backgroundShrink),
+# "paraboloid" (sliding paraboloid) or "bandpass" (FFT band-pass filter); radius of the ball in pixels
+backgroundMethods = ["rolling", "rows", "downsampled", "paraboloid", "bandpass"]
+backgroundMethod = "rolling"
+backgroundRadius = 10
+backgroundShrink = 2
+# target tolerances of the background methods against the rolling ball, not measured on micrographs: maximal mean
+# absolute difference of the corrected image (gray levels, None = not checked) and maximal relative difference of the
+# number of dots found. The benchmark fails if a method exceeds its targets on the synthetic images (see runBenchmark)
+backgroundTolerances = {"rows": [0.0, 0.0], "downsampled": [2.0, 0.01], "paraboloid": [None, 0.01], "bandpass": [None, 0.02]}
+
+# local-maxima detector of the batch mode (detector = maxima, see detectMaxima), without threshold: minimal prominence
+# of the maxima (gray levels), minimal separation between dots and half-width of the window of the sub-pixel centroid
+# (pixels)
+maximaProminence = 20
+maximaSeparation = 6
+maximaWindow = 2
+
+# minimal interval in seconds between two progress reports of a long stage (status bar, or log lines when headless)
+progressInterval = 0.5
+
 #---------------------------------------------------------------
 #----------------- All Functions for analysis  -----------------
 #---------------------------------------------------------------
@@ -119,81 +200,387 @@ def scaleDialog(defaultValue):
 		return v
 
 
-# calculate the Euclidean distance between two vectors
-def euclidean_distance(row1, row2):
-	distance = 0.0
-	for i in range(len(row1)):
-		distance += (row1[i] - row2[i])**2
-	return sqrt(distance)
-	
 def dot(row1, row2):
 	dotproduct = 0
 	for i in range(len(row1)):
 		dotproduct += row1[i]*row2[i]
 	return dotproduct
 
+# Compact representation of the dots (struct of arrays: no object per dot or per neighbor):
+#	centroids = [xs, ys]: two arrays of doubles, the dot i is at (xs[i], ys[i])
+#	neighbors = [counts, indices, distances, angles] (see nearestNeighbors): arrays of ints and doubles with the fixed
+#		stride maxNeighbors, the k-th nearest neighbor of the dot i (k < counts[i]) is at i*maxNeighbors+k
+
+# Centroids [xs, ys] of the coordinates xcentroid, ycentroid
+def dotArrays(xcentroid, ycentroid):
+	return [array('d', list(xcentroid)), array('d', list(ycentroid))]
+
+
+# Spatial index: uniform cell grid built once from the centroids [cells, cellSize, x0, y0, nx, ny]
+# cells[cy*nx+cx] holds the indices of the dots in the cell (cx,cy). By default a cell holds about one dot.
+def cellGrid(centroids_, cellSize=0):
+	xs, ys = centroids_
+	nrow = len(xs)
+	x0 = min(xs)
+	y0 = min(ys)
+	if cellSize <= 0 :
+		cellSize = max(sqrt((max(xs)-x0)*(max(ys)-y0)/nrow), 1.0)
+	nx = int((max(xs)-x0)/cellSize)+1
+	ny = int((max(ys)-y0)/cellSize)+1
+	cells = [[] for c in range(nx*ny)]
+	for idx in range(nrow):
+		cells[int((ys[idx]-y0)/cellSize)*nx + int((xs[idx]-x0)/cellSize)].append(idx)
+	return [cells, cellSize, x0, y0, nx, ny]
+
+
 # Locate the most similar neighbors (based on k-Nearest Neighbors algorithm)
-def get_neighbors(centroids_, idx_, num_neighbors):
+# The cells of the grid are visited ring by ring around the dot until the k-th nearest neighbor is closer
+# than the unvisited rings: the result (and the order of equidistant neighbors) is the same as a full sort.
+def get_neighbors(centroids_, idx_, num_neighbors, grid_=None):
+	if grid_ is None :
+		grid_ = cellGrid(centroids_)
+	cells, cellSize, x0, y0, nx, ny = grid_
+	xs, ys = centroids_
+	xi = xs[idx_]
+	yi = ys[idx_]
+	cx = int((xi-x0)/cellSize)
+	cy = int((yi-y0)/cellSize)
 	distances = list()
-	for row in range(len(centroids_)):
-		if row != idx_ :
-			dist = euclidean_distance(centroids_[idx_], centroids_[row])
-			angl = atan2(centroids_[idx_][1]-centroids_[row][1],centroids_[idx_][0]-centroids_[row][0])
-			distances.append((row, dist, angl))
-	distances.sort(key=lambda tup: tup[1])
+	ring = 0
+	while ring <= max(nx, ny) :
+		for gy in range(max(cy-ring, 0), min(cy+ring+1, ny)):
+			step = 1
+			if ring > 0 and abs(gy-cy) != ring :
+				step = 2*ring # inside the ring, only the first and last columns are new
+			for gx in range(cx-ring, cx+ring+1, step):
+				if gx < 0 or gx >= nx :
+					continue
+				for row in cells[gy*nx+gx]:
+					if row != idx_ :
+						dx = xi-xs[row]
+						dy = yi-ys[row]
+						distances.append((row, sqrt(dx*dx + dy*dy)))
+		# all the dots closer than ring*cellSize are already in the list
+		if len(distances) >= num_neighbors :
+			distances.sort(key=lambda tup: (tup[1], tup[0]))
+			if distances[num_neighbors-1][1] <= ring*cellSize :
+				break
+		ring += 1
+	distances.sort(key=lambda tup: (tup[1], tup[0]))
 	neighbors = list()
 	neighborsdist = list()
 	neighborsangl = list()
-	for i in range(num_neighbors):
-		neighbors.append(distances[i][0])
+	for i in range(min(num_neighbors, len(distances))):
+		row = distances[i][0]
+		neighbors.append(row)
 		neighborsdist.append(distances[i][1])
-		neighborsangl.append(distances[i][2])
+		neighborsangl.append(atan2(yi-ys[row], xi-xs[row]))
 	return [neighbors,neighborsdist, neighborsangl]
 
 
 #check if the ROI is at the edge of the image. This ROI are not considered in the calculation of the spacing and order parameter				
+#(the vertices are read in place, and the test stops at the first vertex at the edge)
 def isRoiAtEdge(polygon, imsize) : 
-	edgeNB = False
-	polypts = map(list, zip(polygon.xpoints,polygon.ypoints))
+	xpoints = polygon.xpoints
+	ypoints = polygon.ypoints
 	for j in range(polygon.npoints):
-		point = polypts[j]
-		for i in  range(2) :
-			edgeNB  |= (point[i] <=1 or point[i] >= (imsize[i]-1))
-	return edgeNB		
+		if xpoints[j] <= 1 or xpoints[j] >= imsize[0]-1 or ypoints[j] <= 1 or ypoints[j] >= imsize[1]-1 :
+			return True
+	return False
+
+
+# Area of the polygon (shoelace formula)
+def polygonArea(polygon):
+	xpoints = polygon.xpoints
+	ypoints = polygon.ypoints
+	area = 0.0
+	k = polygon.npoints-1
+	for j in range(polygon.npoints):
+		area += xpoints[k]*ypoints[j] - xpoints[j]*ypoints[k]
+		k = j
+	return abs(area)/2
 		
 
-def isNeighbors(roi1, roi2):
-	polyRoi1 = ShapeRoi(roi1)
-	polyRoi2 = ShapeRoi(RoiEnlarger.enlarge(roi2, 5))
-	roiAND =polyRoi2.and(polyRoi1)
-	return (roiAND.getLength()  != 0 )
-	
+# check if the dots i and j are neighbors in the Delaunay triangulation (i.e. their Voronoi cells share an edge)
+def isNeighbors(adjacency_, i, j):
+	return j in adjacency_[i]
+
+
+# Orientation of the triangle (a,b,c): > 0 if counter-clockwise, < 0 if clockwise, 0 if flat
+def orientation(a, b, c):
+	return (b[0]-a[0])*(c[1]-a[1]) - (b[1]-a[1])*(c[0]-a[0])
+
+
+# Circumcircle [x, y, squared radius] of the triangle (a,b,c)
+def circumcircle(a, b, c):
+	d = 2*orientation(a, b, c)
+	a2 = a[0]*a[0]+a[1]*a[1]
+	b2 = b[0]*b[0]+b[1]*b[1]
+	c2 = c[0]*c[0]+c[1]*c[1]
+	ux = (a2*(b[1]-c[1]) + b2*(c[1]-a[1]) + c2*(a[1]-b[1]))/d
+	uy = (a2*(c[0]-b[0]) + b2*(a[0]-c[0]) + c2*(b[0]-a[0]))/d
+	return [ux, uy, (a[0]-ux)*(a[0]-ux) + (a[1]-uy)*(a[1]-uy)]
+
+
+#------------- Delaunay triangulation (Bowyer-Watson algorithm) of the centroids  --------------------*/
+#	Bowyer, A. 1981. Computing Dirichlet tessellations. The Computer Journal 24, 162-166.
+#	Watson, D.F. 1981. Computing the n-dimensional Delaunay tessellation. The Computer Journal 24, 167-172.
+# The dots are inserted in the snake order of the cell grid, so the walk to the triangle containing the next dot is
+# short, and the cavity (triangles whose circumcircle contains the dot) is grown from this triangle through the
+# adjacency of the triangles: O(N log N) in practice.
+# Return [triangles, circumcircles, adjacency]: the triangles [a, b, c] (counter-clockwise) with their circumcircles,
+# including the triangles touching the super triangle (vertices >= N, far outside the image) so that every Voronoi
+# cell is closed, and for each dot the set of its Delaunay neighbors (dots only).
+def delaunayTriangulation(centroids_):
+	xs, ys = centroids_
+	nrow = len(xs)
+	pts = [[xs[i], ys[i]] for i in range(nrow)] # working copy, with the vertices of the super triangle
+	cells, cellSize, x0, y0, nx, ny = cellGrid(centroids_)
+	size = max(nx, ny)*cellSize
+	xc = x0 + nx*cellSize/2
+	yc = y0 + ny*cellSize/2
+	pts.append([xc-20*size, yc-10*size])
+	pts.append([xc+20*size, yc-10*size])
+	pts.append([xc, yc+20*size])
+	tv = [[nrow, nrow+1, nrow+2]] # vertices of the triangles
+	tn = [[-1, -1, -1]]           # tn[t][k] = triangle sharing the edge opposite to the vertex tv[t][k]
+	tc = [circumcircle(pts[nrow], pts[nrow+1], pts[nrow+2])]
+	alive = [True]
+	last = 0
+	order = []
+	for gy in range(ny):
+		columns = range(nx)
+		if gy % 2 == 1 :
+			columns.reverse()
+		for gx in columns:
+			order.extend(cells[gy*nx+gx])
+	for idx in order :
+		p = pts[idx]
+		# walk from the last created triangle to the triangle containing p
+		t = last
+		moved = True
+		while moved :
+			v = tv[t]
+			moved = False
+			for k in range(3):
+				if tn[t][k] >= 0 and orientation(pts[v[(k+1)%3]], pts[v[(k+2)%3]], p) < 0 :
+					t = tn[t][k]
+					moved = True
+					break
+		# cavity: the triangles connected to t whose circumcircle contains p, and its boundary edges
+		bad = set([t])
+		stack = [t]
+		boundary = []
+		while stack :
+			b = stack.pop()
+			for k in range(3):
+				nb = tn[b][k]
+				if nb in bad :
+					continue
+				if nb >= 0 :
+					c = tc[nb]
+					if (p[0]-c[0])*(p[0]-c[0]) + (p[1]-c[1])*(p[1]-c[1]) < c[2]*(1-1e-12) :
+						bad.add(nb)
+						stack.append(nb)
+						continue
+				boundary.append((tv[b][(k+1)%3], tv[b][(k+2)%3], nb, b))
+		for b in bad :
+			alive[b] = False
+		# fill the cavity with the triangles [u, v, p]
+		starts = {}
+		ends = {}
+		for u, v, nb, b in boundary :
+			t = len(tv)
+			tv.append([u, v, idx])
+			tn.append([-1, -1, nb])
+			tc.append(circumcircle(pts[u], pts[v], p))
+			alive.append(True)
+			if nb >= 0 :
+				tn[nb][tn[nb].index(b)] = t
+			starts[u] = t
+			ends[v] = t
+		for t in starts.values() :
+			tn[t][0] = starts[tv[t][1]]
+			tn[t][1] = ends[tv[t][0]]
+		last = len(tv)-1
+	triangles = []
+	circles = []
+	adjacency = [set() for i in range(nrow)]
+	for t in range(len(tv)):
+		if alive[t] :
+			triangles.append(tv[t])
+			circles.append(tc[t])
+			for k in range(3):
+				u = tv[t][k]
+				v = tv[t][(k+1)%3]
+				if u < nrow and v < nrow :
+					adjacency[u].add(v)
+	return [triangles, circles, adjacency]
+
+
+# Clip the convex polygon (list of [x,y]) to the rectangle [0,w_]x[0,h_] (Sutherland-Hodgman algorithm)
+def clipPolygon(points, w_, h_):
+	for axis, limit, side in ((0, 0, 1), (0, w_, -1), (1, 0, 1), (1, h_, -1)) :
+		clipped = []
+		for k in range(len(points)):
+			a = points[k-1]
+			b = points[k]
+			ina = (a[axis]-limit)*side >= 0
+			inb = (b[axis]-limit)*side >= 0
+			if ina != inb :
+				f = (limit-a[axis])/float(b[axis]-a[axis])
+				clipped.append([a[0]+f*(b[0]-a[0]), a[1]+f*(b[1]-a[1])])
+			if inb :
+				clipped.append(b)
+		points = clipped
+	return points
+
+
+# Voronoi cell of each dot, clipped to the image, as a FloatPolygon: the circumcenters of its Delaunay triangles
+# sorted by angle around the dot
+def voronoiCells(centroids_, triangles_, circles_, w_, h_):
+	xs, ys = centroids_
+	nrow = len(xs)
+	corners = [[] for i in range(nrow)]
+	for t in range(len(triangles_)):
+		for i in triangles_[t] :
+			if i < nrow :
+				corners[i].append([circles_[t][0], circles_[t][1]])
+	polygons = []
+	for i in range(nrow):
+		xi = xs[i]
+		yi = ys[i]
+		corners[i].sort(key=lambda pt: atan2(pt[1]-yi, pt[0]-xi))
+		cell = clipPolygon(corners[i], w_, h_)
+		polygons.append(FloatPolygon(jarray.array([pt[0] for pt in cell], 'f'), jarray.array([pt[1] for pt in cell], 'f'), len(cell)))
+	return polygons
+
+
+# List the dots j (j != idx_) closer than rmax to the dot idx_ as (j, distance) tuples, using the cell grid
+def neighborsWithin(centroids_, grid_, idx_, rmax):
+	cells, cellSize, x0, y0, nx, ny = grid_
+	xs, ys = centroids_
+	xi = xs[idx_]
+	yi = ys[idx_]
+	pairs = list()
+	for gy in range(max(int((yi-rmax-y0)/cellSize), 0), min(int((yi+rmax-y0)/cellSize)+1, ny)):
+		for gx in range(max(int((xi-rmax-x0)/cellSize), 0), min(int((xi+rmax-x0)/cellSize)+1, nx)):
+			for j in cells[gy*nx+gx]:
+				if j != idx_ :
+					dx = xi-xs[j]
+					dy = yi-ys[j]
+					dij = sqrt(dx*dx + dy*dy)
+					if dij <= rmax :
+						pairs.append((j, dij))
+	return pairs
+
+
+#------------- Curve estimators: K/L(r), g(r) and g6(r)  --------------------*/
+# The three estimators below share their structure (ripleyKCurve, pairCorrelationCurve and orderCorrelationCurve):
+# the loop over the dots i is split into chunks run on nthreads workers, each one with its own partial sums, each dot is
+# counted by progress (see Progress) and the curve is abandoned if the analysis is cancelled. With a sampling budget
+# (see samplingBudget), the curve is estimated from reference dots only (see sampledCurve). The partial sums of each
+# chunk end with the number of pairs it processed (within the cutoff), added to the counter pairs (an AtomicLong) if any.
+
+# Add the numbers of pairs processed by the chunks (the last value of their partial sums) to the counter pairs, if any
+def countPairs(pairs, chunks):
+	if pairs is not None :
+		pairs.addAndGet(sum([chunk[-1] for chunk in chunks]))
+
 
 #------------- Ripley's K-Function or reduced second-moment function (Ripley, 1981)  --------------------*/	
 #	Ripley, B. 1981. Spatial Statistics.  John Wiley, Chichester.
-def RipleyKFunction(w_,h_, centroids_ ,besagFunction, resolution, conversion):
-	print "Plot the Besag's L Function"
+# Single sweep over the pairs: each distance dij is computed once and binned on the first radius r >= dij.
+# A pair inside the edge-free disk of the dot i (dij <= dmin) has a weight 1 for every radius: a cumulative sum of
+# these bins gives its contribution. Otherwise the weight of the dot i only depends on r (edgeWeight), so the
+# cumulative count of its pairs is multiplied by the weight once per radius.
+# Cost: O(N^2 + N.R) instead of O(R.N^2). With rmax > 0, pairs farther than rmax are never enumerated.
+def ripleyKCurve(w_,h_, centroids_ ,besagFunction, resolution, conversion, rmax=0, nthreads=1, progress=None, sample=None, pairs=None):
 	maxd= int(min(w_,h_))
+	if rmax > 0 :
+		maxd = int(min(maxd, rmax))
 	maxres = maxd*resolution
-	plotTitle = "Ripley's K Function"
-	plotTitleY = "K(r)"
-	nrow = len(centroids_)
-	series = XYSeries(plotTitle)
-	for t in range(maxres):
-		kfunc = 0
-		kfuncX = (t+1)/resolution
-		for i in range(nrow) :
-			for j in range(nrow) :
-				if (j!=i) :
-					kfunc+=weightFunction(centroids_[i], centroids_[j],w_,h_, kfuncX)
-		kfunc *= w_*h_/(nrow*(nrow-1))*conversion
+	nrow = len(centroids_[0])
+	radii = [(t+1)/resolution for t in range(maxres)]
+	grid = cellGrid(centroids_)
+	if progress is None :
+		progress = silentProgress
+	values = lambda chunks, scale : ripleyKValues(chunks, scale, w_, h_, nrow, radii, besagFunction, conversion)
+	if sample is not None :
+		return sampledCurve(sample, ripleyKCounts, (w_, h_, centroids_, grid, radii), values, nrow, nthreads, progress, pairs)
+	chunks = runChunks(ripleyKCounts, (w_, h_, centroids_, grid, radii, progress), nrow, nthreads)
+	countPairs(pairs, chunks)
+	progress.check()
+	return values(chunks, 1)
+
+
+# K(r) (or L(r) if besagFunction) from the partial sums of the chunks, with the pair counts multiplied by scale
+def ripleyKValues(chunks, scale, w_, h_, nrow, radii, besagFunction, conversion):
+	kinside = sumChunks([chunk[0] for chunk in chunks])
+	kedge = sumChunks([chunk[1] for chunk in chunks])
+	kfuncXs = []
+	kfuncs = []
+	cumul = 0
+	for t in range(len(radii)):
+		cumul += kinside[t]
+		kfunc = (cumul + kedge[t])*scale
+		kfuncX = radii[t]
+		kfunc *= w_*h_/float(nrow*(nrow-1))*conversion
 		kfuncX *=conversion
 		#return the Besag's L function (1977)
 		if (besagFunction) :
 			kfunc = sqrt(kfunc/pi)- kfuncX
-			plotTitle = "Besag's L Function"
-			plotTitleY = "L(r)"
-		series.add(kfuncX, kfunc)
+		kfuncXs.append(kfuncX)
+		kfuncs.append(kfunc)
+	return [kfuncXs, kfuncs]
+
+
+# Partial sums [kinside, kedge, number of pairs] of ripleyKCurve over the dots start <= i < stop (the reference dots
+# refs[start:stop]), each pair (i, j) being processed for the dot i
+def ripleyKCounts(start, stop, w_, h_, centroids_, grid_, radii, progress, refs=None):
+	xs, ys = centroids_
+	maxres = len(radii)
+	kinside = [0]*maxres
+	kedge = [0.0]*maxres
+	npairs = 0
+	for i in range(start, stop) :
+		if not progress.step() :
+			break
+		if refs is not None :
+			i = refs[i]
+		minx = min(xs[i], w_-xs[i])
+		miny = min(ys[i], h_-ys[i])
+		dmin = min(minx, miny)
+		edgecount = [0]*maxres
+		firstbin = maxres
+		for j, dij in neighborsWithin(centroids_, grid_, i, radii[-1]) :
+			npairs += 1
+			t = bisect_left(radii, dij)
+			if (dij<=dmin) :
+				kinside[t] += 1
+			else :
+				edgecount[t] += 1
+				firstbin = min(firstbin, t)
+		cumul = 0
+		for t in range(firstbin, maxres) :
+			cumul += edgecount[t]
+			kedge[t] += cumul*edgeWeight(minx, miny, radii[t])
+	return [kinside, kedge, npairs]
+
+
+def RipleyKFunction(w_,h_, centroids_ ,besagFunction, resolution, conversion, rmax=0, curve=None, envelope=None):
+	print "Plot the Besag's L Function"
+	plotTitle = "Ripley's K Function"
+	plotTitleY = "K(r)"
+	if (besagFunction) :
+		plotTitle = "Besag's L Function"
+		plotTitleY = "L(r)"
+	if curve is None :
+		curve = ripleyKCurve(w_,h_, centroids_ ,besagFunction, resolution, conversion, rmax)
+	kfuncXs, kfuncs = curve[:2]
+	series = XYSeries(plotTitle)
+	for t in range(len(kfuncXs)):
+		series.add(kfuncXs[t], kfuncs[t])
 	
 	dataset = XYSeriesCollection(series) 
 	yaxis = NumberAxis(plotTitleY)
@@ -201,59 +588,93 @@ def RipleyKFunction(w_,h_, centroids_ ,besagFunction, resolution, conversion):
 	r = XYLineAndShapeRenderer()
 	r.setSeriesPaint(0, Color.BLUE)
 	#r.setSeriesShape(0, Ellipse2D.Double(-3.0,-3.0,6.0,6.0))
+	addBand(dataset, r, curve)
+	if envelope is not None :
+		addEnvelope(dataset, r, envelope)
 	xyplot = XYPlot(dataset, xaxis, yaxis, r)
 	xyplot.setBackgroundPaint(Color.white)
 	chart = JFreeChart(xyplot)
 	chart.removeLegend()
-	impPlot = IJ.createImage(plotTitle, "RGB", 512, 512, 1);
-	imagePlot = impPlot.getBufferedImage()
-	chart.draw(imagePlot.createGraphics(), Rectangle2D.Float(0, 0, impPlot.width, impPlot.height))
-	impPlot.setImage(imagePlot)
-	return impPlot
+	return chartImage(chart, plotTitle)
 		
 
-def weightFunction(row1, row2, w_, h_, dvar):
-	dij = euclidean_distance(row1, row2)
-	minx = min(row1[0], w_-row1[0])
-	miny = min(row1[1], h_-row1[1])
+# Ripley's edge correction weight of a dot at (minx, miny) from the two nearest borders, for a pair farther than 
+# the nearest border: inverse of the proportion of the circle of radius dvar inside the image
+def edgeWeight(minx, miny, dvar):
 	dmin = min(minx, miny)
-	wF=0
-	if (dij<=dvar) :
-		if (dij<=dmin):
-			wF = 1
-		elif (dvar*dvar<=minx*minx+miny*miny):
-			wF = 1/(1-acos(dmin/dvar)/pi)
-		elif (dvar*dvar>minx*minx+miny*miny):
-			wF = 1/(1-(acos(minx/dvar)+acos(miny/dvar)+pi/2)/(2*pi))
-	return wF
+	if (dvar*dvar<=minx*minx+miny*miny):
+		return 1/(1-acos(dmin/dvar)/pi)
+	return 1/(1-(acos(minx/dvar)+acos(miny/dvar)+pi/2)/(2*pi))
+
 
 #Penttinent et al. (1992) Marked point processes in forest statistics. For. Sci. 38, 806-824.
-def PairCorrelation(w_,h_,centroids_, resolution, conversion):
-	print "Plot the pair correlation function"
+# Binned kernel estimator: each pair (i<j) is enumerated once through the cell grid and its kernel weight
+# (counted twice, for (i,j) and (j,i)) is only spread on the radii inside the support |dij - r| < delta.
+# With rmax > 0, the radii stop at rmax and the pairs farther than rmax+delta are never enumerated.
+def pairCorrelationCurve(w_,h_,centroids_, resolution, conversion, rmax=0, nthreads=1, progress=None, sample=None, pairs=None):
 	maxd= int(min(w_,h_))
-	pcf = []
-	pcfX= []
-	pcf.append(0)
-	pcfX.append(0)
-	sd=0
-	nrow = len(centroids_)
-	invlam=w_*h_/nrow
-	plotTitle = "Pair correlation Function"
-	series = XYSeries(plotTitle)
-	for t in range(1,maxd*resolution):
-		pcf = 0
-		pcfX = t/resolution
-		for i in range(nrow) :
-			for j in range(nrow) :
-				if (j!=i) :
-					pcf +=Epanechnikov(centroids_[i], centroids_[j], pcfX, invlam);
-
-
+	if rmax > 0 :
+		maxd = int(min(maxd, rmax))
+	nrow = len(centroids_[0])
+	invlam=w_*h_/float(nrow)
+	delta = 0.15*sqrt(invlam)
+	radii = [t/resolution for t in range(1,maxd*resolution)]
+	grid = cellGrid(centroids_)
+	if progress is None :
+		progress = silentProgress
+	values = lambda chunks, scale : pairCorrelationValues(chunks, scale, w_, h_, radii, invlam, conversion)
+	if sample is not None :
+		return sampledCurve(sample, pairCorrelationSums, (centroids_, grid, radii, delta), values, nrow, nthreads, progress, pairs)
+	chunks = runChunks(pairCorrelationSums, (centroids_, grid, radii, delta, progress), nrow, nthreads)
+	countPairs(pairs, chunks)
+	progress.check()
+	return values(chunks, 1)
+
+
+# g(r) from the partial kernel sums of the chunks, multiplied by scale
+def pairCorrelationValues(chunks, scale, w_, h_, radii, invlam, conversion):
+	pcfs = sumChunks([chunk[0] for chunk in chunks])
+	pcfXs = []
+	for t in range(len(radii)):
+		pcfX = radii[t]
 		#sd= edge correction factor (Stoyan et al. 1987 Stochastic Geometry and its application. Wiley, New York)
 		sd = w_*h_ - pcfX*(2*(w_+h_)-pcfX)/pi
-		pcf *= invlam*invlam/(2*pi*pcfX*sd)
-		pcfX *=conversion
-		series.add(pcfX, pcf)
+		pcfs[t] *= scale*invlam*invlam/(2*pi*pcfX*sd)
+		pcfXs.append(pcfX*conversion)
+	return [pcfXs, pcfs]
+
+
+# Partial kernel sums [pcfs, number of pairs] of pairCorrelationCurve over the pairs (i<j) with start <= i < stop,
+# counted twice. With the reference dots refs, over all the pairs (i, j) of the dots i = refs[start:stop] instead,
+# counted once
+def pairCorrelationSums(start, stop, centroids_, grid_, radii, delta, progress, refs=None):
+	pcfs = [0.0]*len(radii)
+	npairs = 0
+	weight = 2
+	if refs is not None :
+		weight = 1
+	for i in range(start, stop) :
+		if not progress.step() :
+			break
+		if refs is not None :
+			i = refs[i]
+		for j, dij in neighborsWithin(centroids_, grid_, i, radii[-1]+delta) :
+			if j > i or refs is not None :
+				npairs += 1
+				for t in range(bisect_right(radii, dij-delta), bisect_left(radii, dij+delta)) :
+					pcfs[t] += weight*epanechnikovKernel(dij-radii[t], delta)
+	return [pcfs, npairs]
+
+
+def PairCorrelation(w_,h_,centroids_, resolution, conversion, rmax=0, curve=None, envelope=None):
+	print "Plot the pair correlation function"
+	plotTitle = "Pair correlation Function"
+	if curve is None :
+		curve = pairCorrelationCurve(w_,h_,centroids_, resolution, conversion, rmax)
+	pcfXs, pcfs = curve[:2]
+	series = XYSeries(plotTitle)
+	for t in range(len(pcfXs)):
+		series.add(pcfXs[t], pcfs[t])
 	dataset = XYSeriesCollection(series) 
 	yaxis = NumberAxis("g(r)")
 	xaxis = NumberAxis("Distance r (nm)")
@@ -261,6 +682,9 @@ def PairCorrelation(w_,h_,centroids_, resolution, conversion):
 	r.setSeriesPaint(0, Color.BLUE)
 	r.setAutoPopulateSeriesStroke(False)
 	r.setDefaultStroke(BasicStroke(float(2.0)))
+	addBand(dataset, r, curve)
+	if envelope is not None :
+		addEnvelope(dataset, r, envelope)
 	xyplot = XYPlot(dataset, xaxis, yaxis, r)
 	xyplot.setBackgroundPaint(Color.white)
 	marker = ValueMarker(1.0)
@@ -269,77 +693,328 @@ def PairCorrelation(w_,h_,centroids_, resolution, conversion):
 	xyplot.addRangeMarker(marker)
 	chart = JFreeChart(xyplot)
 	chart.removeLegend()
-	impPlot = IJ.createImage(plotTitle, "RGB", 512, 512, 1);
-	imagePlot = impPlot.getBufferedImage()
-	chart.draw(imagePlot.createGraphics(), Rectangle2D.Float(0, 0, impPlot.width, impPlot.height))
-	impPlot.setImage(imagePlot)
-	return impPlot
+	return chartImage(chart, plotTitle)
 
 
-def Epanechnikov(row1, row2, dvar, invlam):
-	dij = euclidean_distance(row1, row2)
-	diff = dij-dvar
-	delta = 0.15*sqrt(invlam)
+# Epanechnikov kernel of half-width delta
+def epanechnikovKernel(diff, delta):
 	Epa = 0
 	if (abs(diff)<delta) :
 		Epa =  3*(1-diff*diff/(delta*delta))/(4*delta)
 	return Epa
 
-def OrderCorrelation(w_,h_, centroids_,  neighbors_):
-	print "Plot the Bond-Orientational Correlation Function"
+
+#------------- Monte Carlo envelopes of complete spatial randomness (CSR)  --------------------*/
+#	Besag, J. & Diggle, P.J. 1977. Simple Monte Carlo tests for spatial pattern. Applied Statistics 26, 327-333.
+# nsim patterns of the same number of dots uniformly distributed in the same window are simulated, and the curve of each
+# pattern is computed with the cutoff-limited estimators (up to envelopeRange mean spacings) on a pool of workers.
+# The min and max of the simulated curves at each radius give the envelope (two-sided test at the level 2/(nsim+1)).
+
+# Curve curveFunction(w_, h_, centroids, *args) of a CSR pattern of nrow dots simulated with the seed
+def simulatedCurve(w_, h_, nrow, seed, curveFunction, args):
+	rnd = random.Random(seed)
+	xs = array('d')
+	ys = array('d')
+	for k in range(nrow):
+		xs.append(rnd.uniform(0, w_))
+		ys.append(rnd.uniform(0, h_))
+	return curveFunction(w_, h_, [xs, ys], *args)
+
+
+# Simulated curve (see simulatedCurve) in a worker of csrEnvelope: None if the analysis is cancelled
+def cancellableCurve(w_, h_, nrow, seed, curveFunction, args):
+	try :
+		return simulatedCurve(w_, h_, nrow, seed, curveFunction, args)
+	except AnalysisCancelled :
+		return None
+
+
+# CSR envelope [xs, lows, highs] of the curve curveFunction(w_, h_, centroids, *args) over nsim simulations of nrow dots.
+# The dots of all the simulations are counted by progress (see Progress), their pairs by the counter pairs, if any
+def csrEnvelope(w_, h_, nrow, nsim, curveFunction, args, nthreads, progress=None, pairs=None):
+	if progress is None :
+		progress = silentProgress
+	curves = runTasks([(cancellableCurve, (w_, h_, nrow, k+1, curveFunction, args+(1, progress, None, pairs))) for k in range(nsim)], nthreads)
+	if None in curves :
+		raise AnalysisCancelled(progress.stage)
+	xs = curves[0][0]
+	lows = [min([curve[1][t] for curve in curves]) for t in range(len(xs))]
+	highs = [max([curve[1][t] for curve in curves]) for t in range(len(xs))]
+	return [xs, lows, highs]
+
+
+# Add the envelope [xs, lows, highs] to the dataset of a plot, as two lines (grey for the CSR envelope)
+def addEnvelope(dataset, renderer, envelope, names=["CSR min", "CSR max"], color=Color.GRAY):
+	for k, name in [(1, names[0]), (2, names[1])] :
+		series = XYSeries(name)
+		for t in range(len(envelope[0])):
+			series.add(envelope[0][t], envelope[k][t])
+		dataset.addSeries(series)
+		renderer.setSeriesPaint(dataset.getSeriesCount()-1, color)
+		renderer.setSeriesShapesVisible(dataset.getSeriesCount()-1, False)
+
+
+# Add the 95% band of an approximate curve [xs, values, lows, highs] (see sampledCurve), if any, to the dataset of a plot
+def addBand(dataset, renderer, curve):
+	if len(curve) > 2 :
+		addEnvelope(dataset, renderer, [curve[0], curve[2], curve[3]], ["95% low", "95% high"], Color.CYAN)
+
+
+#------------- Approximate curves from reference dots  --------------------*/
+#	Efron, B. & Tibshirani, R.J. 1993. An Introduction to the Bootstrap. Chapman & Hall, New York.
+# For a quick look at very large images, the curves can be estimated from a random subset of reference dots i, each one
+# paired with all the dots j (through the cell grid): the cost is linear in N for a given number of reference dots. The
+# pair sums are multiplied by N/(number of reference dots). The reference dots are processed in groups of the same size
+# (independent estimates), and the 95% band of the curve is given by the percentiles of bootstrap resamples of the groups.
+
+# Sampling budget of the approximate curves: None (exact curves) if dots <= 0, else [dots, seconds, error]. The curves
+# start with dots reference dots, then the number of reference dots is doubled until seconds are spent or until the
+# half-width of the band is below error (relative to the largest value of the curve); 0 = no such limit
+def samplingBudget(dots, seconds, error):
+	if dots <= 0 :
+		return None
+	return [dots, seconds, error]
+
+
+# Approximate curve [xs, values, lows, highs] within the sampling budget sample: function(start, stop, *args, progress,
+# refs) gives the partial sums of the reference dots refs[start:stop] and values(groups, scale) the curve from the sums of
+# the groups (run on nthreads workers). The pairs of the reference dots are added to the counter pairs (see countPairs)
+def sampledCurve(sample, function, args, values, nrow, nthreads, progress, pairs=None):
+	dots, seconds, error = sample
+	refs = range(nrow)
+	random.Random(1).shuffle(refs)
+	groupSize = max(1, min(dots, nrow)/sampleGroups)
+	groups = []
+	nrefs = 0
+	size = min(dots, nrow)
+	start = System.nanoTime()
+	while True :
+		bounds = range(nrefs, min(nrefs+size, nrow), groupSize)+[min(nrefs+size, nrow)]
+		progress.begin(progress.stage, bounds[-1]-nrefs)
+		chunks = runTasks([(function, (bounds[k], bounds[k+1])+tuple(args)+(progress, refs)) for k in range(len(bounds)-1)], nthreads)
+		countPairs(pairs, chunks)
+		groups.extend(chunks)
+		progress.check()
+		nrefs = bounds[-1]
+		curve = values(groups, nrow/float(nrefs))
+		if nrefs >= nrow :
+			# all the dots are reference dots: the curve is exact
+			return curve+[list(curve[1]), list(curve[1])]
+		lows, highs = bootstrapBand(groups, values, nrow/float(nrefs), curve)
+		elapsed = (System.nanoTime()-start)/1e9
+		if seconds <= 0 and error <= 0 :
+			break
+		if error > 0 and bandError(curve, lows, highs) <= error :
+			break
+		size = nrefs
+		if seconds > 0 :
+			size = min(size, int((seconds-elapsed)*nrefs/elapsed))
+			if size < groupSize :
+				break
+	return curve+[lows, highs]
+
+
+# 95% band [lows, highs] of the curve [xs, values] over bootstrapResamples resamples (with replacement) of the groups
+def bootstrapBand(groups, values, scale, curve):
+	rnd = random.Random(2)
+	samples = dict([(x, []) for x in curve[0]])
+	for b in range(bootstrapResamples):
+		xs, ys = values([groups[rnd.randrange(len(groups))] for k in range(len(groups))], scale)
+		for t in range(len(xs)):
+			if xs[t] in samples :
+				samples[xs[t]].append(ys[t])
+	lows = []
+	highs = []
+	for t in range(len(curve[0])):
+		v = sorted(samples[curve[0][t]]+[curve[1][t]])
+		lows.append(v[int(round(0.025*(len(v)-1)))])
+		highs.append(v[int(round(0.975*(len(v)-1)))])
+	return [lows, highs]
+
+
+# Largest half-width of the band [lows, highs], relative to the largest absolute value of the curve
+def bandError(curve, lows, highs):
+	top = max([abs(y) for y in curve[1]]+[0])
+	if top == 0 :
+		return 0
+	return max([(highs[t]-lows[t])/2 for t in range(len(lows))]+[0])/top
+
+
+# Besag's L function ("ripley") or pair correlation function ("pcf") of the dots and its CSR envelope over nsim
+# simulations (None if nsim = 0), taken from the cache entry or computed (stages recorded by recorder). The curve and
+# the simulations (each one on a single thread) are computed on nthreads workers, with their progress reported by
+# progress (AnalysisCancelled is raised if the analysis is cancelled). With a sampling budget
+# (see samplingBudget), the curve is approximate, with its 95% band (the envelope is still computed in full).
+# Return [curve, envelope]
+def pairStatistics(entry, recorder, name, w_, h_, centroids_, conversion, nsim, nthreads=1, progress=None, sample=None):
+	if progress is None :
+		progress = silentProgress
+	nrow = len(centroids_[0])
+	function, args, stage = [pairCorrelationCurve, (1, conversion), "PairCorrelation"]
+	if name == "ripley" :
+		function, args, stage = [ripleyKCurve, (True, 1, conversion), "RipleyKFunction"]
+	progress.begin(stage, nrow)
+	pairs = AtomicLong(0)
+	curve = cachedStage(entry, name+" "+repr(conversion)+sampleKey(sample), recordStage, (recorder, stage, function, (w_, h_, centroids_)+args+(0, nthreads, progress, sample, pairs), nrow, pairs))
+	envelope = None
+	if nsim > 0 :
+		rmax = envelopeRange*sqrt(w_*h_/float(nrow))
+		progress.begin(stage+" envelope", nrow*nsim)
+		pairs = AtomicLong(0)
+		envelope = cachedStage(entry, name+" envelope "+str(nsim)+" "+repr(conversion), recordStage, (recorder, stage+" envelope", csrEnvelope, 
+					(w_, h_, nrow, nsim, function, args+(rmax,), nthreads, progress, pairs), nrow*nsim, pairs))
+	return [curve, envelope]
+
+
+# Key of the cached curves computed with the sampling budget sample (empty for the exact curves)
+def sampleKey(sample):
+	if sample is None :
+		return ""
+	return " sample "+" ".join([repr(v) for v in sample])
+
+
+# Save the curve [xs, values] of a plot (or [xs, values, lows, highs] with its 95% band), with its envelope
+# [xs, lows, highs] if any, as a CSV file
+def saveCurve(csvPath, titles, curve, envelope=None):
+	stream = open(csvPath, "w")
+	try :
+		if len(curve) > 2 :
+			titles = titles+["95% low", "95% high"]
+		if envelope is None :
+			stream.write(csvLine(titles))
+		else :
+			stream.write(csvLine(titles+["CSR min", "CSR max"]))
+		for t in range(len(curve[0])):
+			row = [curve[0][t], curve[1][t]]
+			if len(curve) > 2 :
+				row.extend([curve[2][t], curve[3][t]])
+			if envelope is not None :
+				if t < len(envelope[0]) :
+					row.extend([envelope[1][t], envelope[2][t]])
+				else :
+					row.extend(["", ""])
+			stream.write(csvLine(row))
+	finally :
+		stream.close()
+
+
+# Save the attributes of the dots (see dotAttributes) as a CSV file, one row per dot: centroid (pixels), number of
+# Voronoi neighbors, edge flag, area of the Voronoi cell (nm^2) and local |psi6|. The rows are written one at a time
+def saveDotTable(csvPath, datadots, dotTable, conversion):
+	xs, ys = datadots
+	neighborArray, atEdge, areas, psi6 = dotTable
+	stream = open(csvPath, "w")
+	try :
+		stream.write(csvLine(["Dot", "X (pixels)", "Y (pixels)", "Neighbors", "Edge", "Voronoi area (nm^2)", "|psi6|"]))
+		for i in range(len(xs)):
+			stream.write(csvLine([i+1, xs[i], ys[i], neighborArray[i], atEdge[i], areas[i]*conversion*conversion, psi6[i]]))
+	finally :
+		stream.close()
+
+
+# local bond-orientational order parameter psi6 = 1/n sum_k exp(6.I.theta_k) of each dot, computed once from
+# the angles of its 6 nearest bonds, as two arrays [real parts, imaginary parts]
+def localPsi6(neighbors_, nbonds=6):
+	counts, indices, distances, angles = neighbors_
+	nrow = len(counts)
+	psiReal = array('d', [0.0])*nrow
+	psiImg = array('d', [0.0])*nrow
+	for i in range(nrow):
+		nangles = min(counts[i], nbonds)
+		psi_real = 0
+		psi_img = 0
+		for k in range(i*maxNeighbors, i*maxNeighbors+nangles) :
+			psi_real += cos(6 * angles[k])
+			psi_img += sin(6 * angles[k])
+		psiReal[i] = psi_real/nangles
+		psiImg[i] = psi_img/nangles
+	return [psiReal, psiImg]
+
+
+# Bond-orientational correlation function g6(r) = <Re(psi6_i.psi6_j*)> over the pairs of the shell |dij - r| < delta.
+# Each pair (i<j) closer than the maximum radius (+ delta) is enumerated once through the cell grid and its
+# contribution is added to every radius bin of its shell. With rmax > 0, the radii stop at rmax.
+def orderCorrelationCurve(w_,h_, centroids_,  neighbors_, conversion, rmax=0, nthreads=1, progress=None, sample=None, pairs=None):
 	maxd = int(min(w_,h_))
-	nrow = len(neighbors_)
-	invlam = w_*h_/nrow
+	if rmax > 0 :
+		maxd = int(min(maxd, rmax))
+	nrow = len(centroids_[0])
+	invlam = w_*h_/float(nrow)
 	delta = 0.15*sqrt(invlam)
-	plotTitle = "Bond-Orientational Correlation Function"
-	series = XYSeries("RawData")
+	radii = [t+1 for t in range(maxd-1)]
+	psi6 = localPsi6(neighbors_)
+	grid = cellGrid(centroids_)
+	if progress is None :
+		progress = silentProgress
+	values = lambda chunks, scale : orderCorrelationValues(chunks, radii, conversion)
+	if sample is not None :
+		return sampledCurve(sample, orderCorrelationSums, (centroids_, psi6, grid, radii, delta), values, nrow, nthreads, progress, pairs)
+	chunks = runChunks(orderCorrelationSums, (centroids_, psi6, grid, radii, delta, progress), nrow, nthreads)
+	countPairs(pairs, chunks)
+	progress.check()
+	return values(chunks, 1)
+
+
+# g6(r) from the partial sums of the chunks (a ratio of sums: no scale factor)
+def orderCorrelationValues(chunks, radii, conversion):
+	psi_real = sumChunks([chunk[0] for chunk in chunks])
+	nbpts = sumChunks([chunk[1] for chunk in chunks])
 	ocf = []
 	ocfX = []
-	for t in range(maxd-1):
-		bocf = 0
-		bocfX = t+1
-		psi_real = 0
-		nbpts = 0
-		for i in range(nrow-1):
-			for j in range(i+1,nrow):
-				dij = euclidean_distance(centroids_[i], centroids_[j])
-				diff = dij-bocfX
-				if (abs(diff)<delta):
-					nbpts+=1
-					for k in range(6):
-						angli = neighbors_[i][1][k]
-						angltemp = 0
-						psi_realtemp = 0
-						add = True
-						for l in range(6):
-							anglj = neighbors_[j][1][l]
-							if (l == 0): 
-								angltemp = anglj
-							elif (anglj == angltemp):
-								add = False		
-							psi_realtemp += abs(cos(6*(anglj-angli)))
-						if (add) :
-							psi_real+=psi_realtemp
-
-		bocfX *= conversion
-		if (nbpts == 0):
-			bocf = 0
-		else :
-			bocf= psi_real/nbpts/36
+	for t in range(len(radii)):
+		bocfX = radii[t]*conversion
+		if (nbpts[t] > 0):
+			bocf= psi_real[t]/nbpts[t]
 			if (bocf != 0):
 				ocf.append(bocf)
 				ocfX.append(bocfX)
-				series.add(bocfX, bocf)
+	return [ocfX, ocf]
+
+
+# Partial sums [psi_real, nbpts, number of pairs] of orderCorrelationCurve over the pairs (i<j) with start <= i < stop.
+# With the reference dots refs, over all the pairs (i, j) of the dots i = refs[start:stop] instead
+def orderCorrelationSums(start, stop, centroids_, psi6, grid_, radii, delta, progress, refs=None):
+	psiReal, psiImg = psi6
+	psi_real = [0.0]*len(radii)
+	nbpts = [0]*len(radii)
+	npairs = 0
+	for i in range(start, stop) :
+		if not progress.step() :
+			break
+		if refs is not None :
+			i = refs[i]
+		for j, dij in neighborsWithin(centroids_, grid_, i, radii[-1]+delta) :
+			if j > i or refs is not None :
+				npairs += 1
+				corr = psiReal[i]*psiReal[j] + psiImg[i]*psiImg[j]
+				for t in range(bisect_right(radii, dij-delta), bisect_left(radii, dij+delta)) :
+					psi_real[t] += corr
+					nbpts[t] += 1
+	return [psi_real, nbpts, npairs]
+
+
+def OrderCorrelation(w_,h_, centroids_,  neighbors_, conversion, rmax=0, curve=None):
+	print "Plot the Bond-Orientational Correlation Function"
+	plotTitle = "Bond-Orientational Correlation Function"
+	if curve is None :
+		curve = orderCorrelationCurve(w_,h_, centroids_,  neighbors_, conversion, rmax)
+	ocfX, ocf = curve[:2]
+	series = XYSeries("RawData")
+	for t in range(len(ocfX)):
+		series.add(ocfX[t], ocf[t])
 	newsize = len(ocf)
 	
-	# Fitter
-	fitter = CurveFitter(ocfX, ocf)
-	fitter.doFit(CurveFitter.EXPONENTIAL, False) #a*exp(b*x)
-	param_values = fitter.getParams()
-	chi2 = fitter.getRSquared
+	# Fitter: a*exp(b*x) is only defined for g6 > 0, the negative and zero values of g6 are not fitted (no fit with
+	# less than 2 positive values)
+	fitX = [ocfX[t] for t in range(newsize) if ocf[t] > 0]
+	fitY = [ocf[t] for t in range(newsize) if ocf[t] > 0]
 	fitseries = XYSeries("Fit")
-	for xt in ocfX :
-		fitseries.add(xt, fitter.f( param_values, xt))
+	if len(fitX) > 1 :
+		fitter = CurveFitter(fitX, fitY)
+		fitter.doFit(CurveFitter.EXPONENTIAL, False) #a*exp(b*x)
+		param_values = fitter.getParams()
+		for xt in ocfX :
+			fitseries.add(xt, fitter.f( param_values, xt))
 	dataset = XYSeriesCollection() 
 	dataset.addSeries( series )
 	dataset.addSeries( fitseries )
@@ -347,6 +1022,7 @@ def OrderCorrelation(w_,h_, centroids_,  neighbors_):
 	xaxis = NumberAxis("Distance r (nm)")
 	yaxis.setRange(0, 1)
 	if newsize > 0 :
+		yaxis.setRange(min(0, min(ocf)), 1)
 		xaxis.setRange(0, ocfX[newsize-1])
 	renderer= XYLineAndShapeRenderer()
 	renderer.setSeriesPaint( 0 , Color.BLUE )
@@ -354,16 +1030,13 @@ def OrderCorrelation(w_,h_, centroids_,  neighbors_):
 	renderer.setAutoPopulateSeriesStroke(False)
 	renderer.setSeriesStroke( 0 , BasicStroke( float(1.0)) )
 	renderer.setSeriesStroke( 1 , BasicStroke( float(1.0)) )
+	addBand(dataset, renderer, curve)
 	xyplot = XYPlot(dataset, xaxis, yaxis, renderer)
 	xyplot.setBackgroundPaint(Color.white)
     
 	chart = JFreeChart(xyplot)
 	chart.removeLegend()
-	impPlot = IJ.createImage(plotTitle, "RGB", 512, 512, 1);
-	imagePlot = impPlot.getBufferedImage()
-	chart.draw(imagePlot.createGraphics(), Rectangle2D.Float(0, 0, impPlot.width, impPlot.height))
-	impPlot.setImage(imagePlot)
-	return impPlot
+	return chartImage(chart, plotTitle)
 	
 	
 def sVal(dd):
@@ -553,308 +1226,1840 @@ def init(date) :
 	
 	return rowResult
 #---------------------------------------------------------------
+#----------------- Analysis pipeline           -----------------
+#---------------------------------------------------------------
 
-# clear the console automatically when not in headless mode
-uiService.getDefaultUI().getConsolePane().clear()
-
-
-#close Result Table if opened
-if IJ.isResultsWindow() :
-	IJ.run("Clear Results", "")
-	tw = ResultsTable().getResultsWindow()
-	tw.close()
-rt= ResultsTable()
-
-			
-			
-#convert Files from #@ parameters to String and extract the main directory of the data
-impPath = impFile.getCanonicalPath()
-filename = path.splitext(path.basename(impPath))[0]
-
-
-#create folder for analysis 
-srcDir = path.dirname(impPath)
-imageDir = path.join(srcDir, "Analyzed_"+filename) 
-if not path.exists(imageDir):
-	os.makedirs(imageDir)
-
-#open the file
-imp = Opener().openImage(impPath)
-width = imp.width
-height = imp.height
-
-# creation date of the tiff file in the format yyyy/MM/dd
-timestamp = File(impPath).lastModified()
-when = Date(timestamp)
-
-#Measure scale bar
-if imageScale : 
-	imp.show()
-	IJ.setTool("rectangle")
-	waitDialog = WaitForUserDialog("Scale Bar","Draw a rectangle to fit with the scale bar")
-	waitDialog.show()
-	measured = imp.getRoi().getBounds().width
-	known = scaleDialog(200)
-	imp.hide()
-conversion = known/measured
-
-#Crop image
-if imageCrop :
-	imp.show()
-	IJ.setTool("rectangle")
-	waitDialog = WaitForUserDialog("Crop image", "Select a ROI to crop for analysis,\n"+"then click OK when done\n \n"+"Or just click OK for FULL IMAGE selection")
-	waitDialog.show()
-	if imp.getRoi() == None :
-		imp.setRoi(Roi(0,0,width,height))
-	ip_rect= imp.getRoi().getBounds()
-	imp.hide()
-
-restart = True
-while (restart) :
-#---------- Prepare image for Analyze Particles:
-	if imageCrop : #remove manually the information area at the bottom of the image
+# Crop the image to ip_rect (or remove automatically the information area at the bottom of the image for ZEISS SEM
+# if ip_rect is None), subtract the background (method, see correctBackground) and smooth it.
+# Return [imptp, ip_src]: the image to threshold and its 8-bit version (source of the composite)
+def preprocessImage(imp, ip_rect, method="rolling", nthreads=1):
+	if ip_rect is not None :
 		imp.setRoi(ip_rect)
 	else :
-		imp.setRoi(0,0,width,int(height*0.89)) #remove automatically the information area at the bottom of the image (for ZEISS SEM)
+		imp.setRoi(0,0,imp.width,int(imp.height*0.89))
 	imptp = imp.crop()        
 	ip = imptp.getProcessor()
 	ip_src = ip.duplicate().convertToByte(True)
-	BackgroundSubtracter().rollingBallBackground(ip,10,False,False,False,False,True)
+	correctBackground(ip, method, nthreads)
+	return [imptp, ip_src]
+
+
+# Subtract the background (ball of backgroundRadius pixels) and smooth the image. The methods and their target
+# tolerances against the rolling ball (backgroundTolerances, checked by the benchmark on synthetic images only, see
+# runBenchmark):
+#	rolling = rolling ball of ImageJ (reference)
+#	rows = rolling ball on stripes of rows run on nthreads workers, each one with a halo of 3 radii (larger than the
+#		support of the ball): same background as the rolling ball
+#	downsampled = rolling ball on the image shrunk by backgroundShrink (averaging), background enlarged back by
+#		bilinear interpolation: within 2 gray levels of the rolling ball, same dots within 1%
+#	paraboloid = sliding paraboloid of ImageJ with the same radius: different background in the narrow valleys between
+#		dots, same dots within 1%
+#	bandpass = FFT band-pass filter removing the structures larger than the ball: the background is not brought to 0,
+#		same dots within 2% with an automatic threshold only (not with the bounds min,max)
+def correctBackground(ip, method="rolling", nthreads=1):
+	if method == "rolling" :
+		BackgroundSubtracter().rollingBallBackground(ip,backgroundRadius,False,False,False,False,True)
+	elif method == "rows" :
+		for chunk in runChunks(rollingBallRows, (ip, 3*backgroundRadius), ip.getHeight(), nthreads) :
+			ip.insert(chunk[1], 0, chunk[0])
+	elif method == "downsampled" :
+		downsampledBackground(ip, backgroundShrink)
+	elif method == "paraboloid" :
+		BackgroundSubtracter().rollingBallBackground(ip,backgroundRadius,False,False,True,False,True)
+	elif method == "bandpass" :
+		IJ.run(ImagePlus("Background", ip), "Bandpass Filter...", "filter_large=%d filter_small=0 suppress=None tolerance=5" % (2*backgroundRadius))
+	else :
+		raise ValueError("Unknown background correction "+method+" ("+", ".join(backgroundMethods)+")")
 	ip.smooth()
-	width = imptp.width
-	height = imptp.height
-	
-	
-	if not thresholding :
-		imptp.show()
-		ta = ThresholdAdjuster()
-		ta.setMethod("Triangle")
-		ta.show()
-		ta.update()
-		waitDialog = WaitForUserDialog("Manual threshold", "Please, adjust the threshold as desired, then press 'OK' (do not press 'Apply')") # human thresholding
-		waitDialog.show()
-		thres_min = ip.getMinThreshold()
-		thres_max = ip.getMaxThreshold()
-		ta.close()
-		imptp.hide()
-		IJ.setThreshold(imptp, thres_min, thres_max)
+
+
+# Rolling ball on the rows start <= y < stop of ip (read only), with halo rows above and below.
+# Return [start, the corrected rows as a new processor]
+def rollingBallRows(start, stop, ip, halo):
+	top = max(0, start-halo)
+	stripe = ip.createProcessor(ip.getWidth(), min(ip.getHeight(), stop+halo)-top)
+	stripe.copyBits(ip, 0, -top, Blitter.COPY)
+	BackgroundSubtracter().rollingBallBackground(stripe,backgroundRadius,False,False,False,False,True)
+	rows = ip.createProcessor(ip.getWidth(), stop-start)
+	rows.copyBits(stripe, 0, top-start, Blitter.COPY)
+	return [start, rows]
+
+
+# Rolling ball background computed on ip shrunk by shrink (averaging) and subtracted from ip after a bilinear enlargement
+def downsampledBackground(ip, shrink):
+	width = ip.getWidth()
+	height = ip.getHeight()
+	background = ip.resize(int(ceil(width/float(shrink))), int(ceil(height/float(shrink))), True)
+	BackgroundSubtracter().rollingBallBackground(background,backgroundRadius/float(shrink),True,False,False,False,True)
+	background.setInterpolationMethod(ImageProcessor.BILINEAR)
+	ip.copyBits(background.resize(width, height), 0, 0, Blitter.SUBTRACT)
+
+
+# Rectangle analysed in the batch mode: "x,y,width,height", "full" for the full image or "auto" (ZEISS information area
+# removed)
+def analysedRect(crop, width, height):
+	if crop == "full" :
+		return Rectangle(0, 0, width, height)
+	if crop == "auto" :
+		return Rectangle(0, 0, width, int(height*0.89))
+	x, y, w, h = [int(float(v)) for v in crop.split(",")]
+	return Rectangle(x, y, w, h)
+
+
+# Threshold the image with an automatic method (e.g. "Triangle") or with the bounds [min, max], then convert it to mask
+def thresholdImage(imptp, threshold):
+	if isinstance(threshold, list) :
+		IJ.setThreshold(imptp, threshold[0], threshold[1])
 	else :
-		IJ.setAutoThreshold(imptp, "Triangle dark")
+		IJ.setAutoThreshold(imptp, threshold+" dark")
 	IJ.run(imptp, "Convert to Mask", "")
+
+
+# Composite of the segmentation: RED = source OR binary, GREEN = BLUE = source. The OR is done by the Blitter on the
+# whole pixel arrays (no per-pixel loop)
+def segmentationComposite(imptp, ip_src):
+	ip_red = ip_src.duplicate()
+	ip_red.copyBits(imptp.getProcessor(), 0, 0, Blitter.OR)
+	cp = ColorProcessor(ip_src.getWidth(), ip_src.getHeight())
+	cp.setRGB(ip_red.getPixels(), ip_src.getPixels(), ip_src.getPixels())
+	return ImagePlus("RED(Binary)/GRAY(Source)", cp)
+
+
+# Detect signal ROI from the thresholded image (background ROI = inverse of signal ROI): centroids [x, y] of the particles
+def detectDots(imptp, minSize):
+	rt = ResultsTable()
+	p = PA(PA.SHOW_NONE, Measurements.CENTROID, rt ,minSize, MAXSIZE)
+	p.analyze(imptp)
+	if rt.size() == 0 :
+		return [[], []]
+	return [rt.getColumn(rt.getColumnIndex("X")), rt.getColumn(rt.getColumnIndex("Y"))]
+
+
+# Detect the dots as the local maxima of the preprocessed (not thresholded) image ip, without threshold: the maxima more
+# prominent than prominence (MaximumFinder) are searched on stripes of rows on nthreads workers, the maxima closer than
+# separation to a brighter one are removed, and the centroid of each dot is refined in a window around its maximum
+# (see refineMaxima). Return [xs, ys] (same pixel convention as the particle analyzer: pixel centers at +0.5)
+def detectMaxima(ip, prominence, separation, nthreads=1):
+	halo = int(4*separation)+maximaWindow
+	maxima = []
+	for chunk in runChunks(maximaRows, (ip, prominence, halo), ip.getHeight(), nthreads) :
+		maxima.extend(chunk)
+	maxima = separateMaxima(maxima, separation)
+	datadots = [array('d'), array('d')]
+	for xs, ys in runChunks(refineMaxima, (ip, maxima, maximaWindow), len(maxima), nthreads) :
+		datadots[0].extend(xs)
+		datadots[1].extend(ys)
+	return datadots
+
+
+# Maxima (value, x, y) of the rows start <= y < stop of ip (read only), searched with halo rows above and below so that
+# the prominence of the maxima near the stripe borders is measured as on the whole image
+def maximaRows(start, stop, ip, prominence, halo):
+	top = max(0, start-halo)
+	stripe = ip.createProcessor(ip.getWidth(), min(ip.getHeight(), stop+halo)-top)
+	stripe.copyBits(ip, 0, -top, Blitter.COPY)
+	points = MaximumFinder().getMaxima(stripe, prominence, False)
+	maxima = []
+	for k in range(points.npoints):
+		x = points.xpoints[k]
+		y = points.ypoints[k]+top
+		if start <= y < stop :
+			maxima.append((ip.getPixelValue(x, y), x, y))
+	return maxima
+
+
+# Maxima (x, y) kept from the maxima (value, x, y), brightest first: a maximum closer than separation to a kept maximum
+# is removed (cells of side separation hold the kept maxima)
+def separateMaxima(maxima, separation):
+	cells = {}
+	kept = []
+	for value, x, y in sorted(maxima, reverse=True) :
+		cx = int(x/separation)
+		cy = int(y/separation)
+		close = False
+		for gy in range(cy-1, cy+2):
+			for gx in range(cx-1, cx+2):
+				for kx, ky in cells.get((gx, gy), []) :
+					close |= (kx-x)*(kx-x)+(ky-y)*(ky-y) < separation*separation
+		if not close :
+			cells.setdefault((cx, cy), []).append((x, y))
+			kept.append((x, y))
+	return kept
+
+
+# Sub-pixel centroids [xs, ys] of the maxima start <= k < stop: centroid of the window of half-width window around the
+# maximum, weighted by the intensity above the minimum of the window
+def refineMaxima(start, stop, ip, maxima, window):
+	xs = array('d')
+	ys = array('d')
+	for k in range(start, stop):
+		x, y = maxima[k]
+		pixels = [(ip.getPixelValue(i, j), i, j) for j in range(max(0, y-window), min(ip.getHeight(), y+window+1))
+					for i in range(max(0, x-window), min(ip.getWidth(), x+window+1))]
+		base = min([v for v, i, j in pixels])
+		sw = 0.0
+		sx = 0.0
+		sy = 0.0
+		for v, i, j in pixels :
+			sw += v-base
+			sx += (v-base)*i
+			sy += (v-base)*j
+		if sw > 0 :
+			xs.append(sx/sw+0.5)
+			ys.append(sy/sw+0.5)
+		else :
+			xs.append(x+0.5)
+			ys.append(y+0.5)
+	return [xs, ys]
+
+
+# The maxNeighbors nearest neighbors (get_neighbors) of all the dots, searched on nthreads workers.
+# Return [counts, indices, distances, angles]: the number of neighbors of each dot, then the index, distance and angle
+# of each neighbor with the stride maxNeighbors (the missing neighbors of a dot have the index -1)
+def nearestNeighbors(datadots, nthreads=1):
+	grid = cellGrid(datadots)
+	neighbors = [array('i'), array('i'), array('d'), array('d')]
+	for chunk in runChunks(neighborRows, (datadots, grid), len(datadots[0]), nthreads) :
+		for k in range(4):
+			neighbors[k].extend(chunk[k])
+	return neighbors
+
+
+# Neighbors [counts, indices, distances, angles] (see nearestNeighbors) of the dots start <= i < stop
+def neighborRows(start, stop, datadots, grid_):
+	nrow = stop-start
+	counts = array('i', [0])*nrow
+	indices = array('i', [-1])*(nrow*maxNeighbors)
+	distances = array('d', [0.0])*(nrow*maxNeighbors)
+	angles = array('d', [0.0])*(nrow*maxNeighbors)
+	for i in range(start, stop):
+		neighbors, neighborsdist, neighborsangl = get_neighbors(datadots, i, maxNeighbors, grid_)
+		counts[i-start] = len(neighbors)
+		base = (i-start)*maxNeighbors
+		for k in range(len(neighbors)):
+			indices[base+k] = neighbors[k]
+			distances[base+k] = neighborsdist[k]
+			angles[base+k] = neighborsangl[k]
+	return [counts, indices, distances, angles]
+
+
+# Neighbor graph of the dots: [triangles, circles, adjacency, neighbors] = the Delaunay triangulation (with the
+# circumcircles of the triangles), the Delaunay neighbors of each dot and its maxNeighbors nearest neighbors.
+# Its stages are recorded by recorder if it is given, the neighbor search runs on nthreads workers
+def dotGraph(datadots, recorder=None, nthreads=1):
+	nbdots = len(datadots[0])
+	triangles, circles, adjacency = recordStage(recorder, "Voronoi", delaunayTriangulation, (datadots,), nbdots)
+	neighbors = recordStage(recorder, "Neighbour search", nearestNeighbors, (datadots, nthreads), nbdots, nbdots*maxNeighbors)
+	return [triangles, circles, adjacency, neighbors]
+
+
+# Table of the attributes of the dots, computed in a single pass over their Voronoi cells:
+# [neighborArray, atEdge, areas, psi6] = the number of Voronoi (Delaunay) neighbors, the edge flag (cell touching the
+# border of the image, see isRoiAtEdge), the area of the cell clipped to the image (pixels^2) and the local |psi6|
+# (filled by spacingAndOrder). Each dot is counted by progress (see Progress)
+def dotAttributes(polygons, adjacency, width, height, progress=None):
+	if progress is None :
+		progress = silentProgress
+	nrow = len(polygons)
+	neighborArray = array('i', [0])*nrow
+	atEdge = array('b', [0])*nrow
+	areas = array('d', [0.0])*nrow
+	for i in range(nrow):
+		progress.step()
+		neighborArray[i] = len(adjacency[i])
+		atEdge[i] = int(isRoiAtEdge(polygons[i], [width, height]))
+		areas[i] = polygonArea(polygons[i])
+	return [neighborArray, atEdge, areas, array('d', [0.0])*nrow]
+
+
+# Spacing (mean length of the Delaunay bonds between nearest neighbors) and order parameter (mean |psi6|) of the dots
+# whose Voronoi cell is not at the edge of the image (dotTable, see dotAttributes). The local |psi6| of every dot is
+# stored in the table. The loop over the dots is split into chunks run on nthreads workers (see spacingAndOrderSums).
+# Return [dotResult, bonds]: [number of bonds, spacing, stdev, sterror (nm), order] and the bonds of the spacing, as an
+# array of ints i0, j0, i1, j1, ...
+def spacingAndOrder(datadots, dotTable, adjacency, neighbors, conversion, nthreads=1):
+	chunks = runChunks(spacingAndOrderSums, (dotTable, adjacency, neighbors), len(datadots[0]), nthreads)
+	meandist, squaredist, nbdist, phi = sumChunks([chunk[:4] for chunk in chunks])
+	bonds = array('i')
+	psi6 = dotTable[3]
+	start = 0
+	for chunk in chunks :
+		bonds.extend(chunk[4])
+		psi6[start:start+len(chunk[5])] = chunk[5]
+		start += len(chunk[5])
 	
-	#Create composite
-	height = imptp.height
-	cp = ColorProcessor(width,height)
-	rPels = []
-	rS = imptp.getProcessor().getPixels()
-	GS = ip_src.getPixels()
-	for pp in range(width*height) :
-		rPels.append((GS[pp])|(rS[pp]))
-	cp.setRGB(rPels, GS, GS)
-	cimp = ImagePlus("RED(Binary)/GRAY(Source)", cp)
-	cimp.show()
-	question = JOptionPane.showConfirmDialog(None,"Are you ok with the segmentation?")
-	cimp.hide()
-	if (question == JOptionPane.NO_OPTION) :
-		thresholding = False
-		restart = True
-	elif (question == JOptionPane.CANCEL_OPTION):
-		voronoi = False
-		ripleygraph = False 
-		pcfgraph = False
-		ocfgraph = False
-		SaveSpacing = False
-		break
-	else :
-		restart = False
-	
-	
-
-
-# Detect signal ROI from the previous thresholded image (background ROI = inverse of signal ROI)
-p = PA(PA.SHOW_NONE, Measurements.CENTROID, rt ,minSize, MAXSIZE)
-p.analyze(imptp)
-
-
-xcentroid = rt.getColumn(rt.getColumnIndex("X"))
-ycentroid = rt.getColumn(rt.getColumnIndex("Y"))
-xInt = []
-yInt = []
-nbdots = len(xcentroid)
-for i in range(nbdots):
-	xInt.append(int(xcentroid[i])) #integer version of xcentroid
-	yInt.append(int(ycentroid[i])) #integer version of ycentroid
-datadots = map(list, zip(xcentroid, ycentroid))
-
-
-								
-# create voronoi image with color code neighbor number										
-impSpacing = IJ.createImage("Spacing", "8-bit black", width, height, 1)
-ip = impSpacing.getProcessor()
-ip.setLineWidth(3)
-for i in range(nbdots):
-	ip.setColor(Color.WHITE)
-	ip.fillOval(xInt[i]-radius,yInt[i]-radius,2*radius,2*radius)
-IJ.run(impSpacing, "Voronoi", "")
-IJ.setThreshold(impSpacing,1, 255)
-IJ.run(impSpacing, "Convert to Mask", "")
-IJ.run(impSpacing, "Invert", "")
-
-
-neighborArray=[]
-mostNeighbors=0
-roiVoronoi=[]
-for i in range(nbdots): 
-	rt.reset()
-	IJ.doWand(impSpacing, xInt[i], yInt[i], 0.0, "8-connected")
-	roiVoronoi.append(impSpacing.getRoi())
-	IJ.run(impSpacing, "Enlarge...", "enlarge=2")
-	p = PA(PA.SHOW_NONE,Measurements.CENTROID, rt, 0 , Double.POSITIVE_INFINITY)
-	p.analyze(impSpacing)
-	neighborArray.append(rt.size() -1)
-IJ.run(impSpacing, "Invert", "")
-#IJ.saveAs(impSpacing, "TIFF", path.join(imageDir,filename+"_impSpacing.tif"))
-rt.reset()
-
-print "Calculation of spacing and order parameter"
-neighbors = []
-polygons = []
-for i in range(nbdots):
-	neighbors.append(get_neighbors(datadots, i, maxNeighbors))
-	roi = roiVoronoi[i]
-	mark = neighborArray[i]
-	poly = roi.getFloatPolygon().getConvexHull()
-	polygons.append(poly)
-	ip.setColor(voronoiColor)
-	ip.setLineWidth(1)
-	ip.draw(roi)
-	if not isRoiAtEdge(poly, [width, height]) :
-		ip.setColor(mark)
-		ip.fill(roi)
-
-meandist = 0
-squaredist = 0
-nbdist = 0
-phi = 0	
-for i in range(nbdots):
-	psi_real = 0
-	psi_img = 0
-	roi = roiVoronoi[i]
-	mark = neighborArray[i]
-	if not isRoiAtEdge(polygons[i], [width, height]) :
-		ip.setColor(delaunayColor)
-		ip.setLineWidth(2)
-		for j in range(neighborArray[i]) :
-			i2 = int(neighbors[i][0][j])
-			if isNeighbors(roiVoronoi[i], roiVoronoi[i2]):
-				if i2 > i or (i2<i and isRoiAtEdge(polygons[i2], [width, height])) :
-					if not voronoi :
-						ip.drawLine(int(datadots[i][0]),int(datadots[i][1]),int(datadots[i2][0]),int(datadots[i2][1]))
-					meandist += neighbors[i][1][j]
-					squaredist += neighbors[i][1][j]*neighbors[i][1][j]
+	meandist /= nbdist #  measurement in pixels
+	#the variance of equal lengths (perfect lattice) can be rounded to a tiny negative value
+	stdev = sqrt(max(0.0, (squaredist - nbdist * meandist * meandist) / nbdist)) #  measurement in pixels
+	meandist *= conversion # measurement in nm
+	stdev *= conversion # measurement in nm
+	stderror = stdev / sqrt(nbdist)
+	phi = phi/len(datadots[0])
+	#Save data in array	
+	return [[nbdist,meandist, stdev, stderror, phi], bonds]
+
+
+# Partial sums [sum of the bond lengths, sum of their squares, number of bonds, sum of |psi6|, bonds, local |psi6|] of
+# spacingAndOrder over the dots start <= i < stop (the edge flags are read from dotTable, not tested again)
+def spacingAndOrderSums(start, stop, dotTable, adjacency, neighbors):
+	counts, indices, distances, angles = neighbors
+	neighborArray, atEdge = dotTable[:2]
+	meandist = 0
+	squaredist = 0
+	nbdist = 0
+	phi = 0	
+	bonds = array('i')
+	psi6 = array('d', [0.0])*(stop-start)
+	for i in range(start, stop):
+		psi_real = 0
+		psi_img = 0
+		mark = neighborArray[i]
+		for j in range(i*maxNeighbors, i*maxNeighbors+min(neighborArray[i], counts[i])) :
+			i2 = indices[j]
+			if isNeighbors(adjacency, i, i2):
+				if not atEdge[i] and (i2 > i or (i2<i and atEdge[i2])) :
+					bonds.extend((i, i2))
+					meandist += distances[j]
+					squaredist += distances[j]*distances[j]
 					nbdist+=1
-				angl = neighbors[i][2][j]
+				angl = angles[j]
 				psi_real += cos(6 * angl)
 				psi_img += sin(6 * angl)
-			
-		phi += sqrt((psi_real * psi_real + psi_img * psi_img))/mark
-suffix = "_Voronoi"
-if not voronoi :
-	suffix = "_Voronoi-Delaunay"
-	ip.setColor(dotColor)
-	for i in range(nbdots):	
-		ip.fillOval(xInt[i]-radius,yInt[i]-radius,2*radius,2*radius)
-
-
-meandist /= nbdist #  measurement in pixels
-stdev = sqrt( (squaredist - nbdist * meandist * meandist) / nbdist) #  measurement in pixels
-meandist *= conversion # measurement in nm
-stdev *= conversion # measurement in nm
-stderror = stdev / sqrt(nbdist)
-phi = phi/len(neighbors)
-#Save data in array	
-dotResult=[nbdist,meandist, stdev, stderror, phi]	
-
-impSpacing.updateAndDraw()
-IJ.run(impSpacing,"Select None", "")	
-IJ.run(impSpacing, "glasbey inverted", "")
-IJ.resetMinAndMax(impSpacing)
-impSpacing.show()	
-IJ.saveAs(impSpacing, "TIFF", path.join(imageDir,filename+suffix+".tif"))
-
-#draw calibration bar
-mostNeighbors = max(neighborArray)
-stepsize=int(floor(256/mostNeighbors))
-w = stepsize*mostNeighbors
-ipBar = ip.createProcessor(w,50)
-ipBar.setColor(0)
-ipBar.fill()
-step=0
-for c in range(mostNeighbors):
-	ipBar.setColor(c+1)
-	ipBar.fillRect(step, 0, step+stepsize, 30)
-	step+=stepsize
-ipNew = ColorProcessor(ipBar.createImage())
-offset=4
-ipNew.setColor(Color.white)
-middlestep = int(floor(stepsize/2))
-ipNew.setFont(Font("SansSerif", Font.BOLD, 12))
-for c in range(mostNeighbors):
-	ipNew.drawString(str(c+1),middlestep+ c*stepsize-offset, 48)
-impBar = ImagePlus("Calibration Bar", ipNew)
-IJ.saveAs(impBar, "TIFF", path.join(imageDir,filename+"_CalibrationBar.tif"))
-impBar.show()
+		psi6[i-start] = sqrt((psi_real * psi_real + psi_img * psi_img))/mark
+		if not atEdge[i] :
+			phi += psi6[i-start]
+	return [meandist, squaredist, nbdist, phi, bonds, psi6]
+
+
+# Spacing and order parameter of the dots, and the image of the Voronoi (/Delaunay) diagram with the color code of the
+# neighbor number, drawn shrunk by the factor shrink (see diagramShrink). The neighbor graph (see dotGraph) is computed
+# if it is not given. The per-dot loops run on nthreads workers. The per-dot loops over the Voronoi cells report their
+# progress on progress (this stage is never cancelled).
+# Return [dotResult, impSpacing, dotTable, neighbors] (dotTable: attributes of the dots, see dotAttributes)
+def analyzeDots(datadots, width, height, conversion, voronoi, graph=None, nthreads=1, progress=None, shrink=1):
+	if progress is None :
+		progress = silentProgress
+	xs, ys = datadots
+	nbdots = len(xs)
+	# Delaunay triangulation and Voronoi cells computed from the sub-pixel centroids
+	if graph is None :
+		graph = dotGraph(datadots, None, nthreads)
+	triangles, circles, adjacency, neighbors = graph
+	polygons = voronoiCells(datadots, triangles, circles, width, height)
+	progress.begin("Spacing and order", 2*nbdots)
+	dotTable = dotAttributes(polygons, adjacency, width, height, progress)
+	neighborArray, atEdge = dotTable[:2]
+	
+	# create voronoi image with color code neighbor number										
+	impSpacing = IJ.createImage("Spacing", "8-bit black", int(ceil(width/float(shrink))), int(ceil(height/float(shrink))), 1)
+	ip = impSpacing.getProcessor()
+	
+	# the cells (filled by neighbor number), the Voronoi edges, the Delaunay edges and the dots are each gathered in
+	# one shape (in the coordinates of the image) and drawn shrunk in one operation
+	scale = AffineTransform.getScaleInstance(1.0/shrink, 1.0/shrink)
+	shrunk = lambda shape : ShapeRoi(scale.createTransformedShape(shape))
+	cellShapes = {}
+	voronoiShape = Path2D.Float()
+	for i in range(nbdots):
+		progress.step()
+		mark = neighborArray[i]
+		cell = PolygonRoi(polygons[i], Roi.POLYGON).getPolygon()
+		if not atEdge[i] :
+			cellShapes.setdefault(mark, Path2D.Float()).append(cell, False)
+		voronoiShape.append(cell, False)
+	for mark in cellShapes :
+		ip.setColor(mark)
+		ip.fill(shrunk(cellShapes[mark]))
+	ip.setColor(voronoiColor)
+	ip.setLineWidth(1)
+	ip.draw(shrunk(voronoiShape))
+	
+	
+	dotResult, bonds = spacingAndOrder(datadots, dotTable, adjacency, neighbors, conversion, nthreads)
+	if not voronoi :
+		delaunayShape = Path2D.Float()
+		for k in range(0, len(bonds), 2) :
+			delaunayShape.moveTo(int(xs[bonds[k]]),int(ys[bonds[k]]))
+			delaunayShape.lineTo(int(xs[bonds[k+1]]),int(ys[bonds[k+1]]))
+		if len(bonds) > 0 :
+			ip.setColor(delaunayColor)
+			ip.setLineWidth(2)
+			ip.draw(shrunk(delaunayShape))
+		dotShape = Path2D.Float()
+		for i in range(nbdots):	
+			dotShape.append(Ellipse2D.Float(int(xs[i])-radius,int(ys[i])-radius,2*radius,2*radius), False)
+		ip.setColor(dotColor)
+		ip.fill(shrunk(dotShape))
+	
+	impSpacing.updateAndDraw()
+	IJ.run(impSpacing,"Select None", "")	
+	IJ.run(impSpacing, "glasbey inverted", "")
+	IJ.resetMinAndMax(impSpacing)
+	return [dotResult, impSpacing, dotTable, neighbors]
+
+
+#draw calibration bar of the neighbor numbers with the LUT of the Voronoi image
+def calibrationBar(impSpacing, neighborArray):
+	mostNeighbors = max(neighborArray)
+	stepsize=int(floor(256/mostNeighbors))
+	w = stepsize*mostNeighbors
+	# one row of color bands (value c+1 for c neighbors) copied on the 30 first rows, black below
+	band = []
+	for c in range(mostNeighbors):
+		band.extend([c+1]*stepsize)
+	ipBar = ByteProcessor(w, 50, jarray.array(band*30 + [0]*(w*20), 'b'), impSpacing.getProcessor().getColorModel())
+	ipNew = ColorProcessor(ipBar.createImage())
+	offset=4
+	ipNew.setColor(Color.white)
+	middlestep = int(floor(stepsize/2))
+	ipNew.setFont(Font("SansSerif", Font.BOLD, 12))
+	for c in range(mostNeighbors):
+		ipNew.drawString(str(c+1),middlestep+ c*stepsize-offset, 48)
+	return ImagePlus("Calibration Bar", ipNew)
+
+
+# Save the rows of results (with the headings of the CSV file) in a new table
+def saveResultsTable(rows, tablePath, tableTitle=None):
+	dotNewTable= ResultsTable()
+	for row in rows :
+		dotNewTable.incrementCounter()
+		for j in range(len(headings)) :
+			dotNewTable.addValue(headings[j],row[j])
+	if tableTitle is not None :
+		dotNewTable.show(tableTitle)
+	dotNewTable.saveAs(tablePath)
 
-		
 
-if ripleygraph :
-	ripleyplot = RipleyKFunction(width, height, datadots, True, 1, conversion)
-	ripleyplot.show()
-	IJ.saveAs(ripleyplot, "TIFF", path.join(imageDir,filename+"_BesagFunction.tif"))
-if pcfgraph :
-	PCFplot = PairCorrelation(width, height, datadots, 1, conversion)
-	PCFplot.show()
-	IJ.saveAs(PCFplot, "TIFF", path.join(imageDir,filename+"_PCF.tif"))
-if ocfgraph :
-	OCFplot = OrderCorrelation(width, height, datadots, neighbors)
-	OCFplot.show()
-	IJ.saveAs(OCFplot, "TIFF", path.join(imageDir,filename+"_OCF.tif"))
-
-oldfile = False
-
-if SaveSpacing :			
-	addRow = init(when)
-	
-	if len(addRow) >0 :
-		oldfile = addRow[0]
-		addRow[0]= filename
-		addRow.extend(dotResult)
+#---------------------------------------------------------------
+#----------------- Outputs (background writer) -----------------
+#---------------------------------------------------------------
+
+# Image of the chart rendered off-screen: the chart is drawn directly in a 512x512 RGB BufferedImage (no window, no
+# copy of the pixels)
+def chartImage(chart, title):
+	imagePlot = BufferedImage(512, 512, BufferedImage.TYPE_INT_RGB)
+	graphics = imagePlot.createGraphics()
+	try :
+		graphics.setPaint(Color.white)
+		graphics.fillRect(0, 0, imagePlot.getWidth(), imagePlot.getHeight())
+		chart.draw(graphics, Rectangle2D.Float(0, 0, imagePlot.getWidth(), imagePlot.getHeight()))
+	finally :
+		graphics.dispose()
+	return ImagePlus(title, imagePlot)
+
+
+# Write an output (function(*args)) in the thread of the writer: an error is logged and does not stop the other outputs
+def writeSafely(function, args):
+	try :
+		function(*args)
+	except Exception, e :
+		print "Output failed: "+str(e)
+	except Throwable, e :
+		print "Output failed: "+e.toString()
+
+
+# Background writer: the outputs (images, CSV files of the curves) are queued to a single thread which writes them in
+# order while the analysis goes on (next stage, next image). The images are saved in the format imageFormat of
+# outputFormats (the extension of the file is changed accordingly) and must not be modified once queued.
+# close() waits until every queued output is written.
+class OutputWriter:
+	def __init__(self, imageFormat="tiff"):
+		if imageFormat not in outputFormats :
+			raise ValueError("Unknown output format "+imageFormat+" (tiff, zip or png)")
+		self.imageFormat = outputFormats[imageFormat]
+		self.executor = Executors.newSingleThreadExecutor()
+	def write(self, function, args):
+		self.executor.submit(AnalysisTask(writeSafely, (function, args)))
+	def saveImage(self, imp, filePath):
+		self.write(IJ.saveAs, (imp, self.imageFormat, filePath))
+	def saveCurve(self, csvPath, titles, curve, envelope=None):
+		self.write(saveCurve, (csvPath, titles, curve, envelope))
+	def close(self):
+		self.executor.shutdown()
+		self.executor.awaitTermination(Long.MAX_VALUE, TimeUnit.SECONDS)
+
+
+#---------------------------------------------------------------
+#----------------- Results store               -----------------
+#---------------------------------------------------------------
+
+# The results stores are CSV files (with the headings) where the rows are only appended. A store is locked during each
+# append (FileChannel lock, held by the whole JVM: storeLock serializes the threads of this JVM), so that several
+# analyses (threads or processes) can write in the same store
+storeLock = ReentrantLock()
+
+
+# Line of a CSV file (quoted values if needed), with the end of line
+def csvLine(values):
+	line = StringIO()
+	csv.writer(line, lineterminator="\n").writerow([str(v) for v in values])
+	return line.getvalue()
+
+
+# Run function(raf, *args) on the store tablePath opened as a RandomAccessFile and locked
+def lockedStore(tablePath, function, args):
+	storeLock.lock()
+	try :
+		raf = RandomAccessFile(tablePath, "rw")
+		try :
+			lock = raf.getChannel().lock()
+			try :
+				return function(raf, *args)
+			finally :
+				lock.release()
+		finally :
+			raf.close()
+	finally :
+		storeLock.unlock()
+
+
+# Append the rows to the locked store (see appendResults)
+def appendRows(raf, rows):
+	size = raf.length()
+	if size == 0 :
+		raf.write(String(csvLine(headings)).getBytes("UTF-8"))
+	else :
+		raf.seek(0)
+		if len(csv.reader([raf.readLine()]).next()) != len(headings) :
+			return False
+		raf.seek(size-1)
+		if raf.read() != ord("\n") :
+			raf.write(String("\n").getBytes("UTF-8"))
+	raf.seek(raf.length())
+	raf.write(String("".join([csvLine(row) for row in rows])).getBytes("UTF-8"))
+	return True
+
+
+# Append the rows of results to the store tablePath (created with the headings if it does not exist). The cost does not
+# depend on the number of rows of the store. Return False (nothing appended) if the store has other headings
+def appendResults(rows, tablePath):
+	return lockedStore(tablePath, appendRows, (rows,))
+
+
+# Content of the locked store
+def readStore(raf):
+	data = jarray.zeros(raf.length(), "b")
+	raf.seek(0)
+	raf.readFully(data)
+	return String(data, "UTF-8")
+
+
+# Export the store as a results table (CSV file csvPath): the last row of each filename, numbers as numbers
+def exportResults(tablePath, csvPath):
+	content = lockedStore(tablePath, readStore, ())
+	rows = {}
+	order = []
+	for row in list(csv.reader(StringIO(content)))[1:] :
+		if len(row) != len(headings) :
+			continue
+		for j in range(6, len(headings)) :
+			row[j] = float(row[j])
+		if row[0] in rows :
+			order.remove(row[0])
+		rows[row[0]] = row
+		order.append(row[0])
+	saveResultsTable([rows[f] for f in order], csvPath)
+	return len(order)
+
+
+#---------------------------------------------------------------
+#----------------- Analysis cache              -----------------
+#---------------------------------------------------------------
+
+# SHA-1 of the bytes of the image file
+def imageHash(impPath):
+	digest = hashlib.sha1()
+	stream = open(impPath, "rb")
+	try :
+		block = stream.read(1 << 20)
+		while block :
+			digest.update(block)
+			block = stream.read(1 << 20)
+	finally :
+		stream.close()
+	return digest.hexdigest()
+
+
+# Key of the image in the cache: <path>_<bytes>, hashes of its canonical path and of its bytes (see imageHash), so that
+# images of the same name in different folders have their own entries
+def imageKey(impPath):
+	canonical = File(impPath).getCanonicalPath().encode("utf-8")
+	return hashlib.sha1(canonical).hexdigest()[:16]+"_"+imageHash(impPath)[:16]
+
+
+# Prefix of the names of the cache entries of an image (see imageKey) segmented with the parameters segmentation_
+# (analysed rectangle, minimal size of the particles, tiles, ...): <path>_<bytes>_<segmentation>
+def cachePrefix(imageKey, segmentation_):
+	return imageKey+"_"+hashlib.sha1(repr([cacheVersion, segmentation_])).hexdigest()[:16]
+
+
+# Name of the cache entry of the threshold (method or bounds [min, max]): <path>_<bytes>_<segmentation>_<threshold>.cache
+def cacheName(prefix, threshold):
+	return prefix+"_"+hashlib.sha1(repr(threshold)).hexdigest()[:16]+".cache"
+
+
+# Read the cache entry (a dict stage -> data) at entryPath: empty if it does not exist or cannot be read. The entry is
+# unpickled: only the entries of a trusted cache folder must be read
+def loadCache(entryPath):
+	if not path.exists(entryPath) :
+		return {}
+	try :
+		stream = open(entryPath, "rb")
+		try :
+			entry = pickle.load(stream)
+		finally :
+			stream.close()
+	except Exception, e :
+		print "Cache entry "+entryPath+" ignored: "+str(e)
+		return {}
+	os.utime(entryPath, None) # most recently used
+	return entry
+
+
+# Write the cache entry at entryPath. The entries of the same image path with other bytes (modified file) are removed,
+# then the least recently used entries beyond cacheMaxEntries or cacheMaxBytes are evicted
+def saveCache(entryPath, entry):
+	cacheDir = path.dirname(entryPath)
+	if not path.exists(cacheDir):
+		os.makedirs(cacheDir)
+	tmpPath = entryPath+".tmp"
+	stream = open(tmpPath, "wb")
+	try :
+		pickle.dump(entry, stream, pickle.HIGHEST_PROTOCOL)
+	finally :
+		stream.close()
+	if path.exists(entryPath) :
+		os.remove(entryPath)
+	os.rename(tmpPath, entryPath)
+	pathKey, bytesKey = path.basename(entryPath).split("_")[:2]
+	entries = []
+	for f in glob.glob(path.join(cacheDir, "*.cache")):
+		keys = path.basename(f).split("_")
+		if keys[0] == pathKey and keys[1] != bytesKey :
+			os.remove(f)
+		else :
+			entries.append(f)
+	entries.sort(key=path.getmtime, reverse=True)
+	total = 0
+	for k in range(len(entries)):
+		total += path.getsize(entries[k])
+		if entries[k] != entryPath and (k >= cacheMaxEntries or total > cacheMaxBytes) :
+			os.remove(entries[k])
+
+
+# Previous cache entry [entryPath, entry] of the key prefix (see cachePrefix): the entry of the threshold if it is given,
+# else the most recently used entry of any threshold. An entry is only returned if the threshold of its dots gives its
+# name back (same key as the batch mode), else [None, {}]
+def previousEntry(cacheDir, prefix, threshold=None):
+	if threshold is not None :
+		paths = [path.join(cacheDir, cacheName(prefix, threshold))]
+	else :
+		paths = sorted(glob.glob(path.join(cacheDir, prefix+"_*.cache")), key=path.getmtime, reverse=True)
+	for entryPath in paths :
+		entry = loadCache(entryPath)
+		if "dots" in entry and "threshold" in entry and path.basename(entryPath) == cacheName(prefix, entry["threshold"]) :
+			return [entryPath, entry]
+	return [None, {}]
+
+
+# Data of the stage in the cache entry, computed by function(*args) and added to the entry if it is not cached yet
+def cachedStage(entry, stage, function, args):
+	if stage not in entry :
+		entry[stage] = function(*args)
+	return entry[stage]
+
+
+#---------------------------------------------------------------
+#----------------- Stage instrumentation       -----------------
+#---------------------------------------------------------------
+
+# Records of the stages of the analysis of an image: wall and CPU time (of the thread running the stage and of the
+# workers of its loops, see threadCpuTime), JVM heap used
+# before and after the stage, numbers of dots and pairs processed (the pairs can be an AtomicLong counted by the stage,
+# read when it ends, see countPairs). Each record is printed in the Log window if log_
+class StageRecorder(object):
+	def __init__(self, log_=False):
+		self.records = []
+		self.log = log_
+	
+	def run(self, stage, function, args, dots, pairs):
+		runtime = Runtime.getRuntime()
+		heap = (runtime.totalMemory()-runtime.freeMemory())/1048576.0
+		cpu = threadCpuTime()
+		start = System.nanoTime()
+		result = function(*args)
+		if isinstance(pairs, AtomicLong) :
+			pairs = pairs.get()
+		record = [stage, (System.nanoTime()-start)/1e9, (threadCpuTime()-cpu)/1e9, heap, 
+				(runtime.totalMemory()-runtime.freeMemory())/1048576.0, dots, pairs]
+		self.records.append(record)
+		if self.log :
+			IJ.log("%s: wall %.3f s, CPU %.3f s, heap %.0f -> %.0f MB, %d dots, %d pairs" % tuple(record))
+		return result
+	
+	# save the records as a CSV file (one row per stage)
+	def save(self, csvPath):
+		stream = open(csvPath, "w")
+		try :
+			stream.write("Stage,Wall time (s),CPU time (s),Heap before (MB),Heap after (MB),Dots,Pairs\n")
+			for record in self.records :
+				stream.write(",".join([str(v) for v in record])+"\n")
+		finally :
+			stream.close()
+
+
+# Run function(*args) as a stage recorded by recorder (no record if recorder is None) processing dots and pairs
+def recordStage(recorder, stage, function, args, dots=0, pairs=0):
+	if recorder is None :
+		return function(*args)
+	return recorder.run(stage, function, args, dots, pairs)
+
+
+#---------------------------------------------------------------
+#----------------- Progress and cancellation   -----------------
+#---------------------------------------------------------------
+
+# The long loops count their dots on a Progress: at most every progressInterval seconds, the progress of the stage and its
+# time left (from the dots counted per second since the beginning of the stage) are shown in the status bar, or printed as
+# a log line when headless. Each Progress has its own cancel flag, set by Esc in the GUI (for all the images being
+# analysed, then Esc is reset so that the next images are analysed) or by the stop file (for each image while the file
+# exists). The loops stop at their next dot, and the stage raises AnalysisCancelled
+activeProgress = ConcurrentHashMap.newKeySet()
+
+
+# Raised by a stage of the analysis cancelled by the user
+class AnalysisCancelled(Exception):
+	pass
+
+
+# Progress of the stages of the analysis of an image (title), active until finish. Without title, nothing is reported
+# and the stages are never cancelled
+class Progress(object):
+	def __init__(self, title=None, stopFile=""):
+		self.title = title
+		self.stopFile = stopFile
+		self.done = AtomicLong(0)
+		self.nextReport = AtomicLong(0)
+		self.cancelled = AtomicBoolean(False)
+		self.begin("", 0)
+		if title is not None :
+			activeProgress.add(self)
+	
+	# start the stage of total dots
+	def begin(self, stage, total):
+		self.stage = stage
+		self.total = max(1, total)
+		self.done.set(0)
+		self.start = System.nanoTime()
+		self.nextReport.set(self.start+int(progressInterval*1e9))
 	
+	# count n dots done: False if the analysis is cancelled
+	def step(self, n=1):
+		if self.title is None :
+			return True
+		done = self.done.addAndGet(n)
+		now = System.nanoTime()
+		nextReport = self.nextReport.get()
+		if now >= nextReport and self.nextReport.compareAndSet(nextReport, now+int(progressInterval*1e9)) :
+			self.report(done, now)
+		return not self.cancelled.get()
+	
+	def report(self, done, now):
+		if IJ.escapePressed() :
+			IJ.resetEscape()
+			for progress in activeProgress :
+				progress.cancelled.set(True)
+		if len(self.stopFile) > 0 and path.exists(self.stopFile) :
+			self.cancelled.set(True)
+		done = min(done, self.total)
+		elapsed = (now-self.start)/1e9
+		eta = elapsed*(self.total-done)/done
+		if uiService.isHeadless() :
+			print "progress image=%s stage=%s done=%d total=%d percent=%.1f eta=%.0fs" % (self.title, self.stage, done, self.total, 100.0*done/self.total, eta)
+		else :
+			IJ.showProgress(done, self.total)
+			IJ.showStatus("%s - %s: %d%% (%.0f s left, Esc to cancel)" % (self.title, self.stage, 100*done/self.total, eta))
+	
+	# raise AnalysisCancelled if the analysis is cancelled
+	def check(self):
+		if self.title is not None and self.cancelled.get() :
+			raise AnalysisCancelled(self.stage)
+	
+	# end of the stages of the image
+	def finish(self):
+		activeProgress.remove(self)
+		if self.title is not None and not uiService.isHeadless() :
+			IJ.showProgress(1.0)
+			IJ.showStatus("")
+
+
+silentProgress = Progress()
+
+
+#---------------------------------------------------------------
+#----------------- Batch mode (no dialog)      -----------------
+#---------------------------------------------------------------
+
+# Task of the worker pool, with the CPU time in ns of its worker (and of the workers of its own pools) during the task
+class AnalysisTask(Callable):
+	def __init__(self, function, args):
+		self.function = function
+		self.args = args
+		self.cpu = 0
+	def call(self):
+		cpu = threadCpuTime()
+		try :
+			return self.function(*self.args)
+		finally :
+			self.cpu = threadCpuTime()-cpu
+
+
+# CPU time in ns of the tasks run on the pools of each thread (by thread id), see runTasks
+workerCpuTimes = {}
+
+
+# CPU time in ns of the current thread, including the tasks run on its pools (see runTasks): the CPU time of a stage
+# whose loops run on workers
+def threadCpuTime():
+	return ManagementFactory.getThreadMXBean().getCurrentThreadCpuTime()+workerCpuTimes.get(Thread.currentThread().getId(), 0)
+
+
+# Run the tasks (function, args) on a pool of nthreads workers and return their results in the same order. The CPU time
+# of the tasks is added to the calling thread (see threadCpuTime)
+def runTasks(tasks, nthreads):
+	pool = Executors.newFixedThreadPool(max(1, min(nthreads, len(tasks))))
+	try :
+		workers = [AnalysisTask(function, args) for function, args in tasks]
+		futures = pool.invokeAll(ArrayList(workers))
+		try :
+			return [future.get() for future in futures]
+		finally :
+			caller = Thread.currentThread().getId()
+			workerCpuTimes[caller] = workerCpuTimes.get(caller, 0)+sum([worker.cpu for worker in workers])
+	finally :
+		pool.shutdown()
+
+
+# Run the loop over range(n) split into contiguous chunks [start, stop) on nthreads workers: the results of
+# function(start, stop, *args) in the order of the chunks. There are a few chunks per worker (the cost of the dots is
+# not uniform), and a single chunk run in the calling thread if nthreads = 1
+def runChunks(function, args, n, nthreads):
+	nchunks = 1
+	if nthreads > 1 :
+		nchunks = max(1, min(4*nthreads, n))
+	if nchunks == 1 :
+		return [function(0, n, *args)]
+	bounds = [n*k/nchunks for k in range(nchunks+1)]
+	return runTasks([(function, (bounds[k], bounds[k+1])+tuple(args)) for k in range(nchunks)], nthreads)
+
+
+# Sum of the partial arrays of the chunks, element by element (reduced in the order of the chunks)
+def sumChunks(chunks):
+	return [sum(values) for values in zip(*chunks)]
+
+
+# Read the parameter file of the batch mode (key = value, as a java Properties file). The parameters that are not in
+# the file keep the values of the dialog (defaults_):
+#	images = directory or glob pattern of the images (default: the selected file or directory)
+#	measured, known = distance in pixels and known distance in nm
+#	crop = x,y,width,height of the analysed rectangle, "full" for the full image or "auto" (ZEISS information area removed)
+#	threshold = automatic threshold method (e.g. Triangle, Otsu, ...) or the bounds min,max
+#	minSize = minimal size of particles in pixels
+#	diagram = Voronoi Diagram or Voronoi/Delaunay Diagram
+#	ripley, pcf, ocf = true/false to save the Besag's L, pair correlation and bond-orientational correlation functions
+#	envelopes = number of simulations of the CSR envelopes of the Besag's L and pair correlation functions (0 = none)
+#	polymer, loading, concentration, speed, date = metadata of the results table (date: file date if empty)
+#	threads = number of images analysed at the same time (default: number of cores)
+#	cache = true/false to reuse (and save) the cached analysis of the image (default: Reuse the cached analysis)
+#	benchmark = path of the CSV file of the benchmark on synthetic dots (see runBenchmark; default empty: no benchmark)
+#	benchmarkPatterns, benchmarkSizes = synthetic patterns and numbers of dots of the benchmark
+#	benchmarkRmax = maximal distance in pixels of the pair statistics in the benchmark (0 = whole image)
+#	sweep = path of the CSV file of the parameter sweep (see runSweep; default empty: no sweep)
+#	sweepThresholds = thresholds of the sweep separated by ";" (automatic methods or bounds min,max)
+#	sweepMinSizes = minimal sizes of particles of the sweep in pixels, separated by ","
+#	logStages = true/false to print the record of each stage (time, memory) in the Log window (default: logStages)
+#	tile = size in pixels of the tiles for very large images (default 0: the image is analysed as a whole)
+#	halo = width in pixels of the overlap around each tile, larger than the dots (default 32)
+#	tileThreads = number of tiles of an image analysed at the same time (default: number of cores)
+#	diagramSize = largest side in pixels of the Voronoi/Delaunay image in the tiled mode, drawn shrunk for larger
+#		images (default: diagramSize, 0 = full resolution)
+#	loopThreads = number of workers of the per-dot loops of each image (default 0: the cores divided by threads)
+#	format = format of the saved images: tiff, zip (compressed TIFF) or png (default: outputFormat)
+#	stack = true/false to analyse every slice of the stacks, with the same parameters, and save their time series
+#		(default false: only the first slice)
+#	sampleDots = number of reference dots of the approximate correlation functions, with their 95% band (default 0: exact)
+#	sampleSeconds, sampleError = time budget in seconds and target relative half-width of the band of the approximate
+#		correlation functions, reached by doubling the reference dots (default 0: sampleDots reference dots only)
+#	background = background correction: rolling, rows, downsampled, paraboloid or bandpass (default: backgroundMethod,
+#		see correctBackground)
+#	detector = dot detector: particles (threshold and particle analyzer) or maxima (local maxima of the preprocessed
+#		image, without threshold: threshold and minSize are not used, see detectMaxima) (default particles)
+#	prominence = minimal prominence of the maxima in gray levels (default: maximaProminence)
+#	separation = minimal distance between two maxima in pixels (default: maximaSeparation)
+#	stopFile = path of a file whose creation cancels the correlation functions of the images being analysed and of the
+#		next ones, the spacing and order are still saved (default empty: Esc only, in the GUI)
+#	results = path of the combined results store (default: Dot_Analysis_Results.csv in the folder of the images). The
+#		rows are appended to the store: several batches (processes) can write in the same store
+#	export = path of the results table exported from the store at the end of the batch (default empty: no export)
+def readParameters(paramPath, defaults_):
+	props = Properties()
+	stream = FileInputStream(paramPath)
+	try :
+		props.load(stream)
+	finally :
+		stream.close()
+	params = dict(defaults_)
+	for key in props.stringPropertyNames() :
+		params[key] = props.getProperty(key).strip()
+	for key in ["measured", "known", "sampleSeconds", "sampleError", "prominence", "separation"] :
+		params[key] = float(params[key])
+	for key in ["minSize", "envelopes", "threads", "tile", "halo", "tileThreads", "diagramSize", "benchmarkRmax", "loopThreads", "sampleDots"] :
+		params[key] = int(params[key])
+	for key in ["ripley", "pcf", "ocf", "cache", "logStages", "stack"] :
+		params[key] = str(params[key]).lower() in ["true", "yes", "1"]
+	params["voronoi"] = (params["diagram"] == "Voronoi Diagram")
+	threshold = str(params["threshold"]).split(",")
+	if len(threshold) == 2 :
+		params["threshold"] = [float(threshold[0]), float(threshold[1])]
+	return params
+
+
+# List the images to analyse: all the files of a directory, or the files matching a glob pattern
+def listImages(images):
+	if path.isdir(images) :
+		files = [path.join(images, f) for f in os.listdir(images)]
+	else :
+		files = glob.glob(images)
+	return sorted([f for f in files if path.isfile(f) and path.splitext(f)[1].lower() in [".tif", ".tiff", ".png", ".jpg", ".bmp"]])
+
+
+#---------------------------------------------------------------
+#----------------- Tiled mode (very large images) --------------
+#---------------------------------------------------------------
+
+# Size [width, height] of the image, read from the header of the file by Bio-Formats (the pixels are not loaded)
+def imageSize(impPath):
+	reader = ImageProcessorReader()
+	try :
+		reader.setId(impPath)
+		return [reader.getSizeX(), reader.getSizeY()]
+	finally :
+		reader.close()
+
+
+# Read the rectangle rect of the image as an ImagePlus. Without opened image (imp_ = None), Bio-Formats reads only the
+# region from the file (each call has its own reader: the tiles can be read concurrently). Otherwise the region is
+# copied from the processor of imp_, which is only read (no ROI is set on the shared image)
+def readRegion(impPath, rect, imp_=None):
+	if imp_ is None :
+		reader = ImageProcessorReader()
+		try :
+			reader.setId(impPath)
+			ip = reader.openProcessors(0, rect.x, rect.y, rect.width, rect.height)[0]
+		finally :
+			reader.close()
+	else :
+		ip_full = imp_.getProcessor()
+		ip = ip_full.createProcessor(rect.width, rect.height)
+		ip.copyBits(ip_full, -rect.x, -rect.y, Blitter.COPY)
+	return ImagePlus("Tile", ip)
+
+
+# Detect the dots of one tile. The core of the tile is read with a halo (clipped to the analysed rectangle rect), then
+# its background is subtracted (method background, see correctBackground), it is thresholded and the particles are
+# analysed (or, with maxima = [prominence, separation], its local maxima are detected, see detectMaxima). Only the centroids inside the core are kept (in the coordinates of rect): a particle of the overlap zone is
+# complete in the halo of both tiles, but it is kept by the tile owning its centroid only
+def detectTileDots(impPath, imp_, rect, core, halo, threshold, minSize, background="rolling", maxima=None):
+	x0 = max(core.x-halo, rect.x)
+	y0 = max(core.y-halo, rect.y)
+	x1 = min(core.x+core.width+halo, rect.x+rect.width)
+	y1 = min(core.y+core.height+halo, rect.y+rect.height)
+	tile = readRegion(impPath, Rectangle(x0, y0, x1-x0, y1-y0), imp_)
+	correctBackground(tile.getProcessor(), background)
+	if maxima is None :
+		thresholdImage(tile, threshold)
+		xcentroid, ycentroid = detectDots(tile, minSize)
+	else :
+		xcentroid, ycentroid = detectMaxima(tile.getProcessor(), maxima[0], maxima[1])
+	xs = array('d')
+	ys = array('d')
+	for k in range(len(xcentroid)):
+		x = x0 + xcentroid[k]
+		y = y0 + ycentroid[k]
+		if core.x <= x < core.x+core.width and core.y <= y < core.y+core.height :
+			xs.append(x-rect.x)
+			ys.append(y-rect.y)
+	return [xs, ys]
+
+
+# Remove the centroids closer than tol to a centroid listed before them (a dot found by two tiles at their junction,
+# with slightly different centroids because the background of the halos differ)
+def removeDuplicates(centroids_, tol):
+	xs, ys = centroids_
+	if len(xs) < 2 :
+		return centroids_
+	grid = cellGrid(centroids_)
+	kept = [array('d'), array('d')]
+	for i in range(len(xs)):
+		if min([j for j, dij in neighborsWithin(centroids_, grid, i, tol)] + [i]) == i :
+			kept[0].append(xs[i])
+			kept[1].append(ys[i])
+	return kept
+
+
+# Tiled detection of the dots of a very large image (e.g. stitched mosaics): the analysed rectangle (crop, see
+# analysedRect) is cut into tiles of tileSize x tileSize pixels processed concurrently on nthreads workers, and their
+# centroids are stitched together. With Bio-Formats, the memory used depends on the tile size and not on the image size
+# (the file is read tile by tile); without, the image is opened once and only the tiles are processed.
+# With an automatic threshold method, each tile is thresholded with its own histogram.
+# Return [datadots, width, height]: the centroids and the size of the analysed rectangle
+def detectDotsTiled(impPath, crop, threshold, minSize, tileSize, halo, nthreads, background="rolling", maxima=None):
+	imp_ = None
+	if ImageProcessorReader is None :
+		imp_ = Opener().openImage(impPath)
+		width, height = [imp_.width, imp_.height]
+	else :
+		width, height = imageSize(impPath)
+	rect = analysedRect(crop, width, height)
+	tasks = []
+	for y in range(rect.y, rect.y+rect.height, tileSize):
+		for x in range(rect.x, rect.x+rect.width, tileSize):
+			core = Rectangle(x, y, min(tileSize, rect.x+rect.width-x), min(tileSize, rect.y+rect.height-y))
+			tasks.append((detectTileDots, (impPath, imp_, rect, core, halo, threshold, minSize, background, maxima)))
+	print "Tiled detection: "+str(len(tasks))+" tiles of "+str(tileSize)+" pixels on "+str(nthreads)+" threads"
+	datadots = [array('d'), array('d')]
+	for xs, ys in runTasks(tasks, nthreads):
+		datadots[0].extend(xs)
+		datadots[1].extend(ys)
+	return [removeDuplicates(datadots, 1.0), rect.width, rect.height]
+
+
+# Segmentation of one image (or of the slice index > 0 of a stack) with the parameters of the batch mode (whole image or
+# tiles, the slices are not tiled), with its stages recorded by recorder.
+# Return [datadots, width, height]: the centroids and the size of the analysed rectangle
+def segmentImage(impPath, params, recorder=None, index=0):
+	maxima = maximaDetector(params)
+	if params["tile"] > 0 and index == 0 :
+		return recordStage(recorder, "Tiled segmentation", detectDotsTiled, (impPath, str(params["crop"]), params["threshold"], params["minSize"], params["tile"], params["halo"], params["tileThreads"], params["background"], maxima))
+	imptp = recordStage(recorder, "Segmentation", segmentWholeImage, (impPath, params, index))
+	if maxima is None :
+		xcentroid, ycentroid = recordStage(recorder, "Particle analysis", detectDots, (imptp, params["minSize"]))
+	else :
+		xcentroid, ycentroid = recordStage(recorder, "Maxima detection", detectMaxima, (imptp.getProcessor(), maxima[0], maxima[1], params["loopThreads"]))
+	return [dotArrays(xcentroid, ycentroid), imptp.width, imptp.height]
+
+
+# Open (only the slice index > 0 of a stack), crop, preprocess and threshold the image: the mask of the analysed rectangle
+# (with the maxima detector, the preprocessed image is not thresholded)
+def segmentWholeImage(impPath, params, index=0):
+	if index > 0 :
+		imp = readSlice(impPath, index)
+	else :
+		imp = Opener().openImage(impPath)
+	imptp, ip_src = preprocessImage(imp, analysedRect(str(params["crop"]), imp.width, imp.height), params["background"], params["loopThreads"])
+	if maximaDetector(params) is None :
+		thresholdImage(imptp, params["threshold"])
+	return imptp
+
+
+# Dot detector of the batch mode: None for the particle analyzer (threshold, detector = particles) or [prominence,
+# separation] for the local maxima (detector = maxima, see detectMaxima)
+def maximaDetector(params):
+	if params["detector"] == "particles" :
+		return None
+	if params["detector"] == "maxima" :
+		return [params["prominence"], params["separation"]]
+	raise ValueError("Unknown dot detector: "+params["detector"])
+
+
+# Folder Analyzed_<filename> of the outputs of the image, created if needed
+def analysisDir(impPath):
+	imageDir = path.join(path.dirname(impPath), "Analyzed_"+path.splitext(path.basename(impPath))[0])
+	if not path.exists(imageDir):
+		os.makedirs(imageDir)
+	return imageDir
+
+
+# Shrink factor of the Voronoi/Delaunay image of the analysed rectangle width x height: in the tiled mode (not used for
+# the slices), the largest side of the image is at most params["diagramSize"] pixels (0 = full resolution)
+def diagramShrink(width, height, params, index=0):
+	if params["tile"] <= 0 or index > 0 or params["diagramSize"] <= 0 :
+		return 1
+	return max(1, int(ceil(max(width, height)/float(params["diagramSize"]))))
+
+
+# Analysis of one image (or of the slice index > 0 of a stack, named <filename>_t<index>) without any dialog: queue the
+# usual outputs in Analyzed_<filename> to the writer and return the row of results. With the cache (not used for the
+# slices), the stages already computed for the same image bytes and segmentation parameters are skipped
+def analyzeImage(impPath, params, writer, index=0):
+	filename = path.splitext(path.basename(impPath))[0]
+	imageDir = analysisDir(impPath)
+	if index > 0 :
+		filename = sliceName(filename, index)
+	print "Analysis of "+filename
+	conversion = params["known"]/params["measured"]
+	entry = {}
+	if params["cache"] and index == 0 :
+		#the constants of the background correction and of the refinement of the maxima are part of the key
+		segmentation = [str(params["crop"]), params["minSize"], params["tile"], params["halo"]*(params["tile"] > 0), params["background"], backgroundRadius, backgroundShrink]
+		if maximaDetector(params) is not None :
+			segmentation.extend(maximaDetector(params)+[maximaWindow])
+		entryPath = path.join(imageDir, "cache", cacheName(cachePrefix(imageKey(impPath), segmentation), params["threshold"]))
+		entry = loadCache(entryPath)
+	nstages = len(entry)
+	recorder = StageRecorder(params["logStages"])
+	progress = Progress(filename, params["stopFile"])
+	try :
+		datadots, width, height = cachedStage(entry, "dots", segmentImage, (impPath, params, recorder, index))
+		nbdots = len(datadots[0])
+		graph = cachedStage(entry, "graph", dotGraph, (datadots, recorder, params["loopThreads"]))
+		shrink = diagramShrink(width, height, params, index)
+		dotResult, impSpacing, dotTable, neighbors = recordStage(recorder, "Spacing and order", analyzeDots, (datadots, width, height, conversion, params["voronoi"], graph, params["loopThreads"], progress, shrink), nbdots)
+		suffix = "_Voronoi"
+		if not params["voronoi"] :
+			suffix = "_Voronoi-Delaunay"
+		writer.saveImage(impSpacing, path.join(imageDir,filename+suffix+".tif"))
+		writer.saveImage(calibrationBar(impSpacing, dotTable[0]), path.join(imageDir,filename+"_CalibrationBar.tif"))
+		writer.write(saveDotTable, (path.join(imageDir,filename+"Dots.csv"), datadots, dotTable, conversion))
+		#the correlation functions are optional: on cancel, they are abandoned and the spacing and order are still saved
+		sample = samplingBudget(params["sampleDots"], params["sampleSeconds"], params["sampleError"])
+		try :
+			if params["ripley"] :
+				curve, envelope = pairStatistics(entry, recorder, "ripley", width, height, datadots, conversion, params["envelopes"], params["loopThreads"], progress, sample)
+				writer.saveImage(RipleyKFunction(width, height, datadots, True, 1, conversion, curve=curve, envelope=envelope), path.join(imageDir,filename+"_BesagFunction.tif"))
+				writer.saveCurve(path.join(imageDir,filename+"_BesagFunction.csv"), ["r (nm)", "L(r)"], curve, envelope)
+			if params["pcf"] :
+				curve, envelope = pairStatistics(entry, recorder, "pcf", width, height, datadots, conversion, params["envelopes"], params["loopThreads"], progress, sample)
+				writer.saveImage(PairCorrelation(width, height, datadots, 1, conversion, curve=curve, envelope=envelope), path.join(imageDir,filename+"_PCF.tif"))
+				writer.saveCurve(path.join(imageDir,filename+"_PCF.csv"), ["r (nm)", "g(r)"], curve, envelope)
+			if params["ocf"] :
+				progress.begin("OrderCorrelation", nbdots)
+				pairs = AtomicLong(0)
+				curve = cachedStage(entry, "ocf "+repr(conversion)+sampleKey(sample), recordStage, (recorder, "OrderCorrelation", orderCorrelationCurve, (width, height, datadots, neighbors, conversion, 0, params["loopThreads"], progress, sample, pairs), nbdots, pairs))
+				writer.saveImage(OrderCorrelation(width, height, datadots, neighbors, conversion, curve=curve), path.join(imageDir,filename+"_OCF.tif"))
+				writer.saveCurve(path.join(imageDir,filename+"_OCF.csv"), ["r (nm)", "g6(r)"], curve)
+		except AnalysisCancelled, e :
+			print "Analysis of "+filename+" cancelled during "+str(e)+": correlation functions skipped, spacing and order saved"
+	finally :
+		progress.finish()
+	if params["cache"] and index == 0 and len(entry) > nstages :
+		saveCache(entryPath, entry)
+	date = params["date"]
+	if len(date) == 0 :
+		date = SimpleDateFormat("yyyy/MM/dd").format(Date(File(impPath).lastModified()))
+	row = [filename, params["polymer"], params["loading"], params["concentration"], params["speed"], date]
+	row.extend(dotResult)
+	saveResultsTable([row], path.join(imageDir,filename+"Results.csv"))
+	appendResults([row], params["results"])
+	recorder.save(path.join(imageDir,filename+"Stages.csv"))
+	return row
+
+
+# Analysis of one image in the worker pool: an error on an image is logged and does not stop the batch
+def analyzeImageSafely(impPath, params, writer, index=0):
+	try :
+		return analyzeImage(impPath, params, writer, index)
+	except Exception, e :
+		print "Analysis of "+impPath+" failed: "+str(e)
+	except Throwable, e :
+		print "Analysis of "+impPath+" failed: "+e.toString()
+	return None
+
+
+# Analyse the images and slices [(impPath, index)] (index = 0 for a whole image, see imageSlices) concurrently on
+# params["threads"] workers, with their outputs queued to writer, then save the time series of each stack.
+# Return the rows of results of the images and slices analysed
+def analyzeSlices(slices, params, writer):
+	# workers of the per-dot loops of each image (0: the cores left by the images analysed concurrently)
+	if params["loopThreads"] <= 0 :
+		params["loopThreads"] = max(1, Runtime.getRuntime().availableProcessors()/min(params["threads"], len(slices)))
+	rows = runTasks([(analyzeImageSafely, (impPath, params, writer, index)) for impPath, index in slices], params["threads"])
+	stacks = {}
+	for k in range(len(slices)):
+		impPath, index = slices[k]
+		if index > 0 and rows[k] is not None :
+			stacks.setdefault(impPath, []).append([index, rows[k]])
+	for impPath in stacks :
+		saveTimeSeries(impPath, stacks[impPath], writer)
+	return [row for row in rows if row is not None]
+
+
+# Batch mode: analyse all the images (and all the slices of the stacks in the stack mode) concurrently. The outputs of
+# all the images are written by one background writer. The row of each image is appended to the combined results store
+# as soon as the image is analysed, and the store is exported as a results table (last row of each image) if requested
+def runBatch(params):
+	files = listImages(params["images"])
+	if len(files) == 0 :
+		print "No image to analyse in "+params["images"]
+		return
+	print "Batch analysis of "+str(len(files))+" images on "+str(params["threads"])+" threads"
 	IJ.run("Input/Output...", "jpeg=85 gif=-1 file=.csv save_column")
-	if oldfile :
-		op = OpenDialog("Choose CSV file to open", "")
-		tablePath = op.getPath()
-		Opener().openTable(tablePath)
-		tableTitle = path.basename(tablePath)
-		dotTable =  WindowManager.getWindow(tableTitle).getTextPanel().getResultsTable()
-		dotHeadings = dotTable.getHeadings()
-		if not len(headings) == len(dotHeadings) :
-			oldfile = False
+	params = dict(params)
+	if len(params["results"]) == 0 :
+		params["results"] = path.join(path.dirname(files[0]), "Dot_Analysis_Results.csv")
+	slices = []
+	for f in files :
+		slices.extend(imageSlices(f, params))
+	writer = OutputWriter(params["format"])
+	try :
+		rows = analyzeSlices(slices, params, writer)
+	finally :
+		writer.close()
+	print str(len(rows))+" images analysed, results in "+params["results"]
+	if len(params["export"]) > 0 :
+		print str(exportResults(params["results"], params["export"]))+" images exported in "+params["export"]
+
+
+#---------------------------------------------------------------
+#----------------- Stack mode (time series)    -----------------
+#---------------------------------------------------------------
+
+# The slices of a stack (e.g. annealing or tilt series) are analysed as separate images with the same scale, crop and
+# threshold, each one read alone from the file when it is analysed, so that a worker keeps only one slice in memory.
+
+# Number of slices of the image file (read from the header by Bio-Formats, or from a virtual stack)
+def stackSize(impPath):
+	if ImageProcessorReader is not None :
+		reader = ImageProcessorReader()
+		try :
+			reader.setId(impPath)
+			return reader.getImageCount()
+		finally :
+			reader.close()
+	return IJ.openVirtual(impPath).getStackSize()
+
+
+# Read the slice index (1 to stackSize) of the image file as an ImagePlus: only this slice is loaded (plane read by
+# Bio-Formats, or slice of a virtual stack). Each call has its own reader: the slices can be read concurrently
+def readSlice(impPath, index):
+	if ImageProcessorReader is not None :
+		reader = ImageProcessorReader()
+		try :
+			reader.setId(impPath)
+			ip = reader.openProcessors(index-1)[0]
+		finally :
+			reader.close()
+	else :
+		ip = IJ.openVirtual(impPath).getStack().getProcessor(index)
+	return ImagePlus(sliceName(path.splitext(path.basename(impPath))[0], index), ip)
+
+
+# Name of the slice index of the image filename
+def sliceName(filename, index):
+	return filename+"_t%04d" % index
+
+
+# Images to analyse in the image file: [(impPath, index)] for all the slices of a stack in the stack mode
+# (params["stack"]), otherwise [(impPath, 0)] (whole image). The folder of the outputs is created before the slices
+# are analysed concurrently
+def imageSlices(impPath, params):
+	if params["stack"] :
+		nslices = stackSize(impPath)
+		if nslices > 1 :
+			analysisDir(impPath)
+			return [(impPath, index) for index in range(1, nslices+1)]
+	return [(impPath, 0)]
+
+
+# Save the rows of values with the titles as a CSV file
+def saveRows(csvPath, titles, rows):
+	stream = open(csvPath, "w")
+	try :
+		stream.write(csvLine(titles))
+		for row in rows :
+			stream.write(csvLine(row))
+	finally :
+		stream.close()
+
+
+# Time series of the analysed slices [[index, row of results]] of a stack: plot of the spacing (left axis) and order
+# parameter (right axis) against the slice, and CSV file of the results of the slices, queued to writer
+def saveTimeSeries(impPath, slices, writer):
+	filename = path.splitext(path.basename(impPath))[0]
+	imageDir = analysisDir(impPath)
+	slices = sorted(slices)
+	spacingSeries = XYSeries("Spacing (nm)")
+	orderSeries = XYSeries("Order")
+	for index, row in slices :
+		spacingSeries.add(index, row[7])
+		orderSeries.add(index, row[10])
+	spacingRenderer = XYLineAndShapeRenderer()
+	spacingRenderer.setSeriesPaint(0, Color.BLUE)
+	orderRenderer = XYLineAndShapeRenderer()
+	orderRenderer.setSeriesPaint(0, Color.RED)
+	xyplot = XYPlot(XYSeriesCollection(spacingSeries), NumberAxis("Slice"), NumberAxis("Spacing (nm)"), spacingRenderer)
+	spacingAxis = xyplot.getRangeAxis()
+	spacingAxis.setAutoRangeIncludesZero(False)
+	xyplot.setDataset(1, XYSeriesCollection(orderSeries))
+	xyplot.setRangeAxis(1, NumberAxis("Order"))
+	xyplot.mapDatasetToRangeAxis(1, 1)
+	xyplot.setRenderer(1, orderRenderer)
+	xyplot.setBackgroundPaint(Color.white)
+	chart = JFreeChart(xyplot)
+	writer.saveImage(chartImage(chart, filename+" time series"), path.join(imageDir, filename+"_TimeSeries.tif"))
+	writer.write(saveRows, (path.join(imageDir, filename+"_TimeSeries.csv"), ["Slice"]+headings[6:], [[index]+row[6:] for index, row in slices]))
+
+
+#---------------------------------------------------------------
+#----------------- Parameter sweep             -----------------
+#---------------------------------------------------------------
+
+# To choose the segmentation parameters, each image is cropped and preprocessed (background, smoothing) once, each
+# threshold of the sweep is applied to a copy of the preprocessed image and analysed by a single pass of the particle
+# analyzer with the smallest minSize, whose particles are then filtered by every minSize (a particle larger than minSize
+# is exactly a particle kept by the analyzer with minSize). The sweep points (threshold, minSize) are independent.
+
+# Thresholds of the sweep separated by ";": automatic methods (e.g. Triangle) or bounds min,max
+def sweepThresholds(thresholds):
+	values = []
+	for threshold in thresholds.split(";") :
+		bounds = threshold.strip().split(",")
+		if len(bounds) == 2 :
+			values.append([float(bounds[0]), float(bounds[1])])
 		else :
-			rtsize = dotTable.size()
-			for j in range(len(headings)) :
-				dotTable.setValue(headings[j],rtsize, addRow[j])
-			dotTable.saveAs(tablePath)
-	if not oldfile :
-		dotNewTable= ResultsTable()
-		for j in range(len(headings)) :
-			dotNewTable.addValue(headings[j],addRow[j])
-		dotNewTable.show("Dot Analysis Results")
-		dotNewTable.saveAs(path.join(imageDir,filename+"Results.csv"))
+			values.append(threshold.strip())
+	return values
+
+
+# Threshold a copy of the preprocessed image and detect the particles larger than the smallest of minSizes in one pass.
+# Return the centroids of the particles kept by each minSize: [[minSize, datadots]]
+def sweepThreshold(imptp, threshold, minSizes):
+	imp = imptp.duplicate()
+	thresholdImage(imp, threshold)
+	rt = ResultsTable()
+	p = PA(PA.SHOW_NONE, Measurements.CENTROID+Measurements.AREA, rt, min(minSizes), MAXSIZE)
+	p.analyze(imp)
+	if rt.size() == 0 :
+		return [[minSize, dotArrays([], [])] for minSize in minSizes]
+	# area of the particles in pixels (the area of the results table is calibrated)
+	cal = imp.getCalibration()
+	pixels = [int(round(a/(cal.pixelWidth*cal.pixelHeight))) for a in rt.getColumn(rt.getColumnIndex("Area"))]
+	xcentroid = rt.getColumn(rt.getColumnIndex("X"))
+	ycentroid = rt.getColumn(rt.getColumnIndex("Y"))
+	configurations = []
+	for minSize in minSizes :
+		kept = [i for i in range(len(pixels)) if pixels[i] >= minSize]
+		configurations.append([minSize, dotArrays([xcentroid[i] for i in kept], [ycentroid[i] for i in kept])])
+	return configurations
+
+
+# Spacing and order parameter of the dots of one sweep point (no image of the diagram): the values of dotResult, or
+# empty values if there are too few dots (or no bond between dots inside the image)
+def sweepPoint(datadots, width, height, conversion):
+	if len(datadots[0]) < 3 :
+		return ["", "", "", "", ""]
+	triangles, circles, adjacency, neighbors = dotGraph(datadots)
+	polygons = voronoiCells(datadots, triangles, circles, width, height)
+	try :
+		return spacingAndOrder(datadots, dotAttributes(polygons, adjacency, width, height), adjacency, neighbors, conversion)[0]
+	except ZeroDivisionError :
+		return ["", "", "", "", ""]
+
+
+# Sweep of the segmentation parameters on all the images of params["images"]: the thresholds of sweepThresholds and the
+# minimal sizes of sweepMinSizes, with the scale and crop of the parameter file. Each image is preprocessed once, the
+# thresholds are applied on params["threads"] workers, then the sweep points run on params["threads"] workers.
+# One row per image and sweep point (number of particles, spacing and order parameter) in the CSV file params["sweep"]
+def runSweep(params):
+	files = listImages(params["images"])
+	if len(files) == 0 :
+		print "No image to analyse in "+params["images"]
+		return
+	thresholds = sweepThresholds(params["sweepThresholds"])
+	minSizes = sorted([int(v) for v in params["sweepMinSizes"].split(",")])
+	conversion = params["known"]/params["measured"]
+	rows = []
+	for impPath in files :
+		filename = path.splitext(path.basename(impPath))[0]
+		print "Parameter sweep of "+filename+": "+str(len(thresholds)*len(minSizes))+" sweep points"
+		imp = Opener().openImage(impPath)
+		imptp, ip_src = preprocessImage(imp, analysedRect(str(params["crop"]), imp.width, imp.height), params["background"], loopThreads)
+		detections = runTasks([(sweepThreshold, (imptp, threshold, minSizes)) for threshold in thresholds], params["threads"])
+		points = []
+		for k in range(len(thresholds)) :
+			label = thresholds[k]
+			if isinstance(label, list) :
+				label = "%g,%g" % tuple(label)
+			for minSize, datadots in detections[k] :
+				points.append([label, minSize, datadots])
+		results = runTasks([(sweepPoint, (datadots, imptp.width, imptp.height, conversion)) for label, minSize, datadots in points], params["threads"])
+		for k in range(len(points)) :
+			label, minSize, datadots = points[k]
+			rows.append([filename, label, minSize, len(datadots[0])]+results[k])
+	saveRows(params["sweep"], ["Filename", "Threshold", "Min size (pixels)", "Particles"]+headings[6:], rows)
+	print "Parameter sweep results in "+params["sweep"]
+
+
+#---------------------------------------------------------------
+#----------------- Benchmark (synthetic dots)  -----------------
+#---------------------------------------------------------------
+
+# Synthetic centroids of about n dots spaced by a pixels in a square window of side size (area of n hexagonal cells):
+#	hexagonal = perfect hexagonal lattice, jittered = hexagonal lattice with a gaussian noise of a/10,
+#	polycrystalline = 8 hexagonal domains with random orientations (Voronoi cells of random seeds),
+#	poisson = complete spatial randomness.
+# Return [centroids, size]
+def syntheticDots(pattern, n, a, rnd):
+	size = sqrt(n*a*a*sqrt(3)/2)
+	if pattern == "poisson" :
+		return [[[rnd.uniform(0, size), rnd.uniform(0, size)] for k in range(n)], size]
+	seeds = [[size/2, size/2]]
+	angles = [0.0]
+	if pattern == "polycrystalline" :
+		seeds = [[rnd.uniform(0, size), rnd.uniform(0, size)] for d in range(8)]
+		angles = [rnd.uniform(0, pi/3) for d in range(8)]
+	noise = 0
+	if pattern == "jittered" :
+		noise = a/10.0
+	m = int(size/a)+2
+	centroids = []
+	for d in range(len(seeds)):
+		cx, cy = seeds[d]
+		c = cos(angles[d])
+		s = sin(angles[d])
+		for j in range(-m, m+1):
+			for i in range(-m, m+1):
+				u = (i+j/2.0)*a
+				v = j*a*sqrt(3)/2
+				x = cx + c*u - s*v + rnd.gauss(0, noise)
+				y = cy + s*u + c*v + rnd.gauss(0, noise)
+				if 0 <= x < size and 0 <= y < size :
+					# the dot belongs to the domain of the nearest seed
+					nearest = min(range(len(seeds)), key=lambda k: (x-seeds[k][0])**2+(y-seeds[k][1])**2)
+					if nearest == d :
+						centroids.append([x, y])
+	return [centroids, size]
+
+
+# Synthetic micrograph of the centroids: bright disks of radius a/4 on a black background
+def syntheticImage(centroids_, size, a):
+	ip = ByteProcessor(int(size)+1, int(size)+1)
+	dotShape = Path2D.Float()
+	for x, y in centroids_ :
+		dotShape.append(Ellipse2D.Float(x-a/4.0, y-a/4.0, a/2.0, a/2.0), False)
+	ip.setColor(200)
+	ip.fill(ShapeRoi(dotShape))
+	return ImagePlus("Synthetic dots", ip)
+
+
+# Synthetic micrograph with an uneven background: a horizontal ramp of 0 to 50 gray levels added to the image
+def shadedImage(imp_):
+	ramp = IJ.createImage("Ramp", "8-bit ramp", imp_.width, imp_.height, 1).getProcessor()
+	ramp.multiply(0.2)
+	ip = imp_.getProcessor().duplicate()
+	ip.copyBits(ramp, 0, 0, Blitter.ADD)
+	return ImagePlus("Shaded synthetic dots", ip)
+
+
+# Background correction of the image by method (see correctBackground), then Otsu threshold and particle analysis.
+# Return [time of the correction (s), corrected processor, number of dots found]
+def correctedSynthetic(imp_, method, minSize, nthreads):
+	ip = imp_.getProcessor().duplicate()
+	t, result = timed(correctBackground, (ip, method, nthreads))
+	imptp = ImagePlus("Background "+method, ip.duplicate())
+	thresholdImage(imptp, "Otsu")
+	return [t, ip, len(detectDots(imptp, minSize)[0])]
+
+
+# Check of the background method against its target tolerances (see backgroundTolerances): mean absolute difference of
+# its corrected image from the rolling ball and number of dots found (count with the rolling ball). Return "pass" or
+# "FAIL"
+def backgroundCheck(method, difference, found, count):
+	maxDifference, maxDots = backgroundTolerances[method]
+	if maxDifference is not None and difference > maxDifference :
+		return "FAIL"
+	if abs(found-count) > maxDots*count :
+		return "FAIL"
+	return "pass"
+
+
+# Segmentation of the whole synthetic image (preprocessing, Otsu threshold, particle analysis): [xcentroid, ycentroid]
+def segmentSynthetic(imp_, minSize):
+	imptp, ip_src = preprocessImage(imp_, Rectangle(0, 0, imp_.width, imp_.height))
+	thresholdImage(imptp, "Otsu")
+	return detectDots(imptp, minSize)
+
+
+# Detection of the local maxima of the preprocessed synthetic image (see detectMaxima): [xs, ys]
+def maximaSynthetic(imp_, nthreads):
+	imptp, ip_src = preprocessImage(imp_, Rectangle(0, 0, imp_.width, imp_.height))
+	return detectMaxima(imptp.getProcessor(), maximaProminence, maximaSeparation, nthreads)
+
+
+# Time in seconds of function(*args) and its result: [seconds, result]
+def timed(function, args):
+	start = System.nanoTime()
+	result = function(*args)
+	return [(System.nanoTime()-start)/1e9, result]
+
+
+# Voronoi neighbor counting: [triangles, circles, adjacency, dotTable] (see delaunayTriangulation and dotAttributes)
+def voronoiNeighbors(datadots, width, height):
+	triangles, circles, adjacency = delaunayTriangulation(datadots)
+	polygons = voronoiCells(datadots, triangles, circles, width, height)
+	return [triangles, circles, adjacency, dotAttributes(polygons, adjacency, width, height)]
+
+
+# Number of nearest neighbors which are Delaunay neighbors (isNeighbors)
+def countDelaunayNeighbors(adjacency, neighbors):
+	counts, indices, distances, angles = neighbors
+	count = 0
+	for i in range(len(counts)):
+		for k in range(i*maxNeighbors, i*maxNeighbors+counts[i]) :
+			if isNeighbors(adjacency, i, indices[k]) :
+				count += 1
+	return count
+
+
+# Rendering of the Voronoi/Delaunay image and calibration bar, and their TIFF/CSV outputs in outDir
+def saveOutputs(datadots, width, height, graph, outDir):
+	dotResult, impSpacing, dotTable, neighbors = analyzeDots(datadots, width, height, 1.0, False, graph, loopThreads)
+	IJ.saveAs(impSpacing, "TIFF", path.join(outDir, "Synthetic_Voronoi-Delaunay.tif"))
+	IJ.saveAs(calibrationBar(impSpacing, dotTable[0]), "TIFF", path.join(outDir, "Synthetic_CalibrationBar.tif"))
+	saveDotTable(path.join(outDir, "SyntheticDots.csv"), datadots, dotTable, 1.0)
+	saveResultsTable([["Synthetic", "", "", "", "", ""]+dotResult], path.join(outDir, "SyntheticResults.csv"))
+	return dotResult
+
+
+# Benchmark of every stage of the analysis on synthetic dots (patterns x numbers of dots, spacing of 20 pixels). Each
+# row of the CSV file params["benchmark"] gives the time of a stage with a value checked against its known answer
+# (Expected, when there is one): number of dots found by the segmentation and by the maxima detector, mean distance to
+# the nearest neighbor, mean number of Voronoi neighbors, spacing (order parameter in Order), max |L(r)|, position of the
+# peak of g(r) and g6 of the first shell. Each background correction (see correctBackground) of the synthetic image with
+# an uneven background gives the number of dots found (Expected: with the rolling ball) and, in Order, the mean absolute
+# difference of its corrected image from the rolling ball (gray levels), checked against its target tolerances (Check,
+# see backgroundCheck): the benchmark raises an error after saving the CSV file if a method exceeds them. The pair
+# statistics stop at benchmarkRmax pixels (0 = whole image, as in the analysis). The per-dot loops and the rows
+# background correction run on loopThreads workers (0 = all the cores, 1 = serial)
+def runBenchmark(params):
+	a = 20.0
+	rmax = params["benchmarkRmax"]
+	nthreads = params["loopThreads"]
+	if nthreads <= 0 :
+		nthreads = loopThreads
+	rnd = random.Random(1)
+	outDir = tempfile.mkdtemp()
+	lines = ["Pattern,Dots,Stage,Time (s),Value,Expected,Order,Check"]
+	failures = []
+	try :
+		for pattern in [p.strip() for p in params["benchmarkPatterns"].split(",")] :
+			for n in [int(v) for v in params["benchmarkSizes"].split(",")] :
+				centroids, size = syntheticDots(pattern, n, a, rnd)
+				width = height = int(size)+1
+				nbdots = len(centroids)
+				lattice = ""
+				if pattern != "poisson" :
+					lattice = a
+				print "Benchmark "+pattern+": "+str(nbdots)+" dots"
+				rows = []
+				t, found = timed(segmentSynthetic, (syntheticImage(centroids, size, a), params["minSize"]))
+				rows.append(["segmentation", t, len(found[0]), nbdots, ""])
+				t, found = timed(maximaSynthetic, (syntheticImage(centroids, size, a), nthreads))
+				rows.append(["maxima", t, len(found[0]), nbdots, ""])
+				shaded = shadedImage(syntheticImage(centroids, size, a))
+				t, reference, count = correctedSynthetic(shaded, "rolling", params["minSize"], nthreads)
+				rows.append(["background rolling", t, count, count, 0])
+				checks = {}
+				for method in backgroundMethods[1:] :
+					t, ip, found = correctedSynthetic(shaded, method, params["minSize"], nthreads)
+					ip.copyBits(reference, 0, 0, Blitter.DIFFERENCE)
+					difference = ip.getStatistics().mean
+					checks["background "+method] = backgroundCheck(method, difference, found, count)
+					if checks["background "+method] != "pass" :
+						failures.append(pattern+" "+str(nbdots)+" dots: background "+method)
+					rows.append(["background "+method, t, found, count, difference])
+				datadots = dotArrays([x for x, y in centroids], [y for x, y in centroids])
+				t, neighbors = timed(nearestNeighbors, (datadots, nthreads))
+				expected = lattice
+				if pattern == "poisson" :
+					expected = 0.5*size/sqrt(nbdots)
+				rows.append(["get_neighbors", t, sum([neighbors[2][i*maxNeighbors] for i in range(nbdots)])/nbdots, expected, ""])
+				t, voro = timed(voronoiNeighbors, (datadots, width, height))
+				triangles, circles, adjacency, dotTable = voro
+				rows.append(["voronoi", t, sum(dotTable[0])/float(nbdots), 6, ""])
+				t, count = timed(countDelaunayNeighbors, (adjacency, neighbors))
+				rows.append(["isNeighbors", t, count, "", ""])
+				t, spacing = timed(spacingAndOrder, (datadots, dotTable, adjacency, neighbors, 1.0, nthreads))
+				rows.append(["spacing/psi6", t, spacing[0][1], lattice, spacing[0][4]])
+				t, curve = timed(ripleyKCurve, (width, height, datadots, True, 1, 1.0, rmax, nthreads))
+				expected = ""
+				if pattern == "poisson" :
+					expected = 0
+				rows.append(["RipleyKFunction", t, max([abs(l) for l in curve[1]]), expected, ""])
+				t, curve = timed(pairCorrelationCurve, (width, height, datadots, 1, 1.0, rmax, nthreads))
+				rows.append(["PairCorrelation", t, curve[0][curve[1].index(max(curve[1]))], lattice, ""])
+				t, curve = timed(orderCorrelationCurve, (width, height, datadots, neighbors, 1.0, rmax, nthreads))
+				expected = ""
+				if pattern == "hexagonal" :
+					expected = 1
+				rows.append(["OrderCorrelation", t, curve[1][0], expected, ""])
+				t, dotResult = timed(saveOutputs, (datadots, width, height, [triangles, circles, adjacency, neighbors], outDir))
+				rows.append(["TIFF/CSV output", t, "", "", ""])
+				for stage, t, value, expected, order in rows :
+					lines.append(",".join([pattern, str(nbdots), stage, str(t), str(value), str(expected), str(order), checks.get(stage, "")]))
+	finally :
+		#the synthetic images and outputs (hundreds of MB for the largest patterns) are removed
+		shutil.rmtree(outDir, True)
+	stream = open(params["benchmark"], "w")
+	try :
+		stream.write("\n".join(lines)+"\n")
+	finally :
+		stream.close()
+	print "Benchmark results in "+params["benchmark"]
+	if len(failures) > 0 :
+		raise RuntimeError("Background tolerances exceeded ("+", ".join(failures)+"), see "+params["benchmark"])
 
-		
-print "Results:"
-for i in range(len(dotResult)):
-	print headings[i+6]+" = "+ str(dotResult[i])
 
-print 'END'
\ No newline at end of file
+#---------------------------------------------------------------
+
+# clear the console automatically when not in headless mode
+if not uiService.isHeadless() :
+	uiService.getDefaultUI().getConsolePane().clear()
+
+
+#Esc pressed before this run does not cancel it
+IJ.resetEscape()
+
+#parameters of the analysis without dialog (batch mode, slices of a stack): the parameters of the dialog are the defaults
+defaults = {"images": impFile.getCanonicalPath(), "measured": measured, "known": known, "crop": "auto", "threshold": "Triangle",
+			"minSize": minSize, "diagram": vorodiagram, "ripley": ripleygraph, "pcf": pcfgraph, "ocf": ocfgraph, "envelopes": envelopes,
+			"polymer": "", "loading": "", "concentration": "", "speed": "", "date": "",
+			"threads": Runtime.getRuntime().availableProcessors(), "results": "", "export": "",
+			"cache": useCache, "logStages": logStages, "benchmark": "", "benchmarkPatterns": "hexagonal,jittered,polycrystalline,poisson",
+			"benchmarkSizes": "500,2000,10000,100000", "benchmarkRmax": 200, "tile": 0, "halo": 32, "tileThreads": Runtime.getRuntime().availableProcessors(), "diagramSize": diagramSize,
+			"format": outputFormat, "loopThreads": 0, "stack": False,
+			"sweep": "", "sweepThresholds": "Triangle;Otsu;Huang;Li", "sweepMinSizes": "5,10,20,40", "stopFile": "", "background": backgroundMethod,
+			"sampleDots": sampleDots, "sampleSeconds": sampleSeconds, "sampleError": sampleError,
+			"detector": "particles", "prominence": maximaProminence, "separation": maximaSeparation}
+
+if paramFile is not None :
+	#batch mode: the parameters of the dialog are the defaults of the parameter file
+	params = readParameters(paramFile.getCanonicalPath(), defaults)
+	if len(params["benchmark"]) > 0 :
+		runBenchmark(params)
+	elif len(params["sweep"]) > 0 :
+		runSweep(params)
+	else :
+		runBatch(params)
+else :
+	#close Result Table if opened
+	if IJ.isResultsWindow() :
+		IJ.run("Clear Results", "")
+		tw = ResultsTable().getResultsWindow()
+		tw.close()
+	
+	#convert Files from #@ parameters to String and extract the main directory of the data
+	impPath = impFile.getCanonicalPath()
+	filename = path.splitext(path.basename(impPath))[0]
+	
+	
+	#create folder for analysis 
+	srcDir = path.dirname(impPath)
+	imageDir = path.join(srcDir, "Analyzed_"+filename) 
+	if not path.exists(imageDir):
+		os.makedirs(imageDir)
+	
+	#open the file
+	imp = Opener().openImage(impPath)
+	width = imp.width
+	height = imp.height
+	
+	# creation date of the tiff file in the format yyyy/MM/dd
+	timestamp = File(impPath).lastModified()
+	when = Date(timestamp)
+	
+	#Measure scale bar
+	if imageScale : 
+		imp.show()
+		IJ.setTool("rectangle")
+		waitDialog = WaitForUserDialog("Scale Bar","Draw a rectangle to fit with the scale bar")
+		waitDialog.show()
+		measured = imp.getRoi().getBounds().width
+		known = scaleDialog(200)
+		imp.hide()
+	conversion = known/measured
+	
+	#Crop image (otherwise the information area at the bottom of the image is removed automatically)
+	ip_rect = None
+	if imageCrop :
+		imp.show()
+		IJ.setTool("rectangle")
+		waitDialog = WaitForUserDialog("Crop image", "Select a ROI to crop for analysis,\n"+"then click OK when done\n \n"+"Or just click OK for FULL IMAGE selection")
+		waitDialog.show()
+		if imp.getRoi() == None :
+			imp.setRoi(Roi(0,0,width,height))
+		ip_rect= imp.getRoi().getBounds()
+		imp.hide()
+	
+	#cache of the analysis of this image and crop (one entry per threshold): the segmentation of the previous analysis
+	#can be reused
+	entry = {}
+	if useCache :
+		segmentation = ["auto", minSize, 0, 0, backgroundMethod, backgroundRadius, backgroundShrink]
+		if ip_rect is not None :
+			segmentation[0] = "%d,%d,%d,%d" % (ip_rect.x, ip_rect.y, ip_rect.width, ip_rect.height)
+		cacheDir = path.join(imageDir, "cache")
+		prefix = cachePrefix(imageKey(impPath), segmentation)
+		#automatic threshold: only its own entry; manual threshold: the last one chosen for this crop and minimal size
+		previousPath, previous = previousEntry(cacheDir, prefix, [None, "Triangle"][thresholding])
+		if previousPath is not None and JOptionPane.showConfirmDialog(None, "Reuse the segmentation of the previous analysis (threshold "+str(previous["threshold"])+")?", title, JOptionPane.YES_NO_OPTION) == JOptionPane.YES_OPTION :
+			entryPath = previousPath
+			entry = previous
+	
+	restart = "dots" not in entry
+	threshold = entry.get("threshold", "Triangle")
+	impPre = None
+	recorder = StageRecorder(logStages)
+	while (restart) :
+	#---------- Prepare image for Analyze Particles: the crop is preprocessed once, each threshold attempt works on a copy
+		if impPre is None :
+			impPre, ip_src = recordStage(recorder, "Segmentation", preprocessImage, (imp, ip_rect, backgroundMethod, loopThreads))
+		imptp = impPre.duplicate()
+		imptp.setTitle(impPre.getTitle())
+		ip = imptp.getProcessor()
+		width = imptp.width
+		height = imptp.height
+		
+		
+		if not thresholding :
+			imptp.show()
+			ta = ThresholdAdjuster()
+			ta.setMethod("Triangle")
+			ta.show()
+			ta.update()
+			waitDialog = WaitForUserDialog("Manual threshold", "Please, adjust the threshold as desired, then press 'OK' (do not press 'Apply')") # human thresholding
+			waitDialog.show()
+			thres_min = ip.getMinThreshold()
+			thres_max = ip.getMaxThreshold()
+			ta.close()
+			imptp.hide()
+			threshold = [thres_min, thres_max]
+		else :
+			threshold = "Triangle"
+		thresholdImage(imptp, threshold)
+		
+		#Create composite
+		cimp = segmentationComposite(imptp, ip_src)
+		cimp.show()
+		question = JOptionPane.showConfirmDialog(None,"Are you ok with the segmentation?")
+		cimp.hide()
+		if (question == JOptionPane.NO_OPTION) :
+			thresholding = False
+			restart = True
+		elif (question == JOptionPane.CANCEL_OPTION):
+			voronoi = False
+			ripleygraph = False 
+			pcfgraph = False
+			ocfgraph = False
+			SaveSpacing = False
+			break
+		else :
+			restart = False
+		
+		
+	
+	
+	if "dots" not in entry and useCache :
+		entryPath = path.join(cacheDir, cacheName(prefix, threshold))
+		entry = loadCache(entryPath)
+	nstages = len(entry)
+	datadots, width, height = cachedStage(entry, "dots", lambda : [dotArrays(*recordStage(recorder, "Particle analysis", detectDots, (imptp, minSize))), width, height], ())
+	#threshold of the segmentation, kept with the dots for the slices of a stack
+	threshold = entry.setdefault("threshold", threshold)
+	nbdots = len(datadots[0])
+	
+	print "Calculation of spacing and order parameter"
+	graph = cachedStage(entry, "graph", dotGraph, (datadots, recorder, loopThreads))
+	#the images, plots and curves are written in the background while the analysis goes on
+	writer = OutputWriter(outputFormat)
+	try :
+		progress = Progress(filename)
+		try :
+			dotResult, impSpacing, dotTable, neighbors = recordStage(recorder, "Spacing and order", analyzeDots, (datadots, width, height, conversion, voronoi, graph, loopThreads, progress), nbdots)
+			suffix = "_Voronoi"
+			if not voronoi :
+				suffix = "_Voronoi-Delaunay"
+			impSpacing.show()	
+			writer.saveImage(impSpacing, path.join(imageDir,filename+suffix+".tif"))
+	
+			#draw calibration bar
+			impBar = calibrationBar(impSpacing, dotTable[0])
+			writer.saveImage(impBar, path.join(imageDir,filename+"_CalibrationBar.tif"))
+			impBar.show()
+			writer.write(saveDotTable, (path.join(imageDir,filename+"Dots.csv"), datadots, dotTable, conversion))
+	
+			
+	
+			#Esc cancels the correlation functions: the spacing and order are still saved
+			sample = samplingBudget(sampleDots, sampleSeconds, sampleError)
+			try :
+				if ripleygraph :
+					curve, envelope = pairStatistics(entry, recorder, "ripley", width, height, datadots, conversion, envelopes, loopThreads, progress, sample)
+					ripleyplot = RipleyKFunction(width, height, datadots, True, 1, conversion, curve=curve, envelope=envelope)
+					ripleyplot.show()
+					writer.saveImage(ripleyplot, path.join(imageDir,filename+"_BesagFunction.tif"))
+					writer.saveCurve(path.join(imageDir,filename+"_BesagFunction.csv"), ["r (nm)", "L(r)"], curve, envelope)
+				if pcfgraph :
+					curve, envelope = pairStatistics(entry, recorder, "pcf", width, height, datadots, conversion, envelopes, loopThreads, progress, sample)
+					PCFplot = PairCorrelation(width, height, datadots, 1, conversion, curve=curve, envelope=envelope)
+					PCFplot.show()
+					writer.saveImage(PCFplot, path.join(imageDir,filename+"_PCF.tif"))
+					writer.saveCurve(path.join(imageDir,filename+"_PCF.csv"), ["r (nm)", "g(r)"], curve, envelope)
+				if ocfgraph :
+					progress.begin("OrderCorrelation", nbdots)
+					pairs = AtomicLong(0)
+					curve = cachedStage(entry, "ocf "+repr(conversion)+sampleKey(sample), recordStage, (recorder, "OrderCorrelation", orderCorrelationCurve, (width, height, datadots, neighbors, conversion, 0, loopThreads, progress, sample, pairs), nbdots, pairs))
+					OCFplot = OrderCorrelation(width, height, datadots, neighbors, conversion, curve=curve)
+					OCFplot.show()
+					writer.saveImage(OCFplot, path.join(imageDir,filename+"_OCF.tif"))
+					writer.saveCurve(path.join(imageDir,filename+"_OCF.csv"), ["r (nm)", "g6(r)"], curve)
+			except AnalysisCancelled, e :
+				print "Analysis cancelled during "+str(e)+": correlation functions skipped, spacing and order saved"
+		finally :
+			progress.finish()
+		if useCache and len(entry) > nstages :
+			saveCache(entryPath, entry)
+		recorder.save(path.join(imageDir,filename+"Stages.csv"))
+	
+		oldfile = False
+		metadata = []
+	
+		if SaveSpacing :			
+			addRow = init(when)
+		
+			if len(addRow) >0 :
+				oldfile = addRow[0]
+				metadata = addRow[1:6]
+				addRow[0]= filename
+				addRow.extend(dotResult)
+		
+			IJ.run("Input/Output...", "jpeg=85 gif=-1 file=.csv save_column")
+			if oldfile :
+				op = OpenDialog("Choose CSV file to open", "")
+				tablePath = op.getPath()
+				oldfile = tablePath is not None and appendResults([addRow], tablePath)
+			if not oldfile :
+				saveResultsTable([addRow], path.join(imageDir,filename+"Results.csv"), "Dot Analysis Results")
+	
+		#stack: all the slices are analysed without dialog with the scale, crop and threshold of this one
+		nslices = imp.getStackSize()
+		if nslices > 1 and JOptionPane.showConfirmDialog(None, "Analyse the "+str(nslices)+" slices of the stack with the same scale, crop and threshold?", title, JOptionPane.YES_NO_OPTION) == JOptionPane.YES_OPTION :
+			params = dict(defaults)
+			params.update({"measured": measured, "known": known, "threshold": threshold, "voronoi": voronoi, "ripley": ripleygraph, "pcf": pcfgraph,
+						"ocf": ocfgraph, "stack": True, "results": path.join(imageDir, filename+"StackResults.csv")})
+			if ip_rect is not None :
+				params["crop"] = "%d,%d,%d,%d" % (ip_rect.x, ip_rect.y, ip_rect.width, ip_rect.height)
+			if len(metadata) > 0 :
+				params.update(dict(zip(["polymer", "loading", "concentration", "speed", "date"], metadata)))
+			rows = analyzeSlices(imageSlices(impPath, params), params, writer)
+			print str(len(rows))+" slices analysed, results in "+params["results"]
+	finally :
+		#the writer thread must stop even if the analysis fails, or Fiji cannot exit
+		writer.close()
+	
+			
+	print "Results:"
+	for i in range(len(dotResult)):
+		print headings[i+6]+" = "+ str(dotResult[i])
+	
+	print 'END'
@@ -0,0 +1,8 @@
+# Dot_Analyzer analysis core for CPython (NumPy/SciPy): spacing, order parameter and correlation functions of the
+# centroids of the dots, with the same results as the Fiji script Dot_Analyzer14.py (see dot_analyzer/core.py)
+
+from dot_analyzer.core import (maxNeighbors, nearest_neighbors, delaunay_graph, spacing_order, ripley_k,
+	pair_correlation, local_psi6, order_correlation, analyze)
+
+__all__ = ["maxNeighbors", "nearest_neighbors", "delaunay_graph", "spacing_order", "ripley_k", "pair_correlation",
+	"local_psi6", "order_correlation", "analyze"]
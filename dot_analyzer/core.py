@@ -0,0 +1,265 @@
+#*******************************************************************************
+#
+#	Dot_Analyzer analysis core (CPython, NumPy/SciPy)
+#
+#	Copyright 2022 - BSD-3-Clause license
+#
+#******************************************************************************/
+
+# Vectorised version of the analysis of Dot_Analyzer14.py, usable outside Fiji (e.g. on exported centroids).
+# The centroids are an array (N, 2) of [x, y] in pixels in the analysed window [0, width] x [0, height], and each
+# function returns the same numbers as the function of the script named in its comment (up to the rounding of the
+# sums, and to the choice of the triangulation of cocircular dots).
+
+import numpy as np
+from scipy.spatial import cKDTree, Delaunay
+
+# maximum number of neighbors (for calculation), as in the script
+maxNeighbors = 12
+
+
+def _points(centroids):
+	points = np.asarray(centroids, dtype=float)
+	if points.ndim != 2 or points.shape[1] != 2 :
+		raise ValueError("centroids must be an array of shape (N, 2)")
+	return points
+
+
+# Distances between the dots i and j
+def _distances(points, i, j):
+	dx = points[i, 0] - points[j, 0]
+	dy = points[i, 1] - points[j, 1]
+	return np.sqrt(dx*dx + dy*dy)
+
+
+# All the pairs (i < j) closer than rmax: [i, j, dij]
+def _pairs(points, rmax):
+	pairs = cKDTree(points).query_pairs(rmax, output_type="ndarray")
+	i = pairs[:, 0]
+	j = pairs[:, 1]
+	dij = _distances(points, i, j)
+	keep = dij <= rmax
+	return [i[keep], j[keep], dij[keep]]
+
+
+# get_neighbors: the k nearest neighbors of each dot sorted by (distance, index).
+# Return [indices, distances, angles], arrays (N, k) padded with -1 / nan if there are less than k other dots
+def nearest_neighbors(centroids, k=maxNeighbors):
+	points = _points(centroids)
+	nrow = len(points)
+	kq = min(nrow, 2*k+1) # margin for the neighbors at the same distance
+	idx = cKDTree(points).query(points, k=kq)[1].reshape(nrow, kq)
+	rows = np.repeat(np.arange(nrow), kq).reshape(nrow, kq)
+	idx = np.where(idx == rows, nrow, idx) # the dot itself is removed (sorted last)
+	safe = np.minimum(idx, nrow-1)
+	dist = np.where(idx == nrow, np.inf, _distances(points, rows, safe))
+	order = np.lexsort((idx, dist), axis=1)
+	idx = np.take_along_axis(idx, order, axis=1)[:, :k]
+	dist = np.take_along_axis(dist, order, axis=1)[:, :k]
+	missing = idx == nrow
+	safe = np.minimum(idx, nrow-1)
+	angles = np.arctan2(points[:, 1][:, None] - points[safe, 1], points[:, 0][:, None] - points[safe, 0])
+	ncols = idx.shape[1]
+	if ncols < k :
+		pad = np.full((nrow, k-ncols), True)
+		missing = np.hstack([missing, pad])
+		idx = np.hstack([idx, np.zeros((nrow, k-ncols), dtype=idx.dtype)])
+		dist = np.hstack([dist, np.zeros((nrow, k-ncols))])
+		angles = np.hstack([angles, np.zeros((nrow, k-ncols))])
+	return [np.where(missing, -1, idx), np.where(missing, np.nan, dist), np.where(missing, np.nan, angles)]
+
+
+# delaunayTriangulation / voronoiCells / isRoiAtEdge: Delaunay graph of the dots.
+# Return [edges, counts, atEdge]: the Delaunay edges (i < j) as an array (E, 2), the number of Delaunay neighbors of each
+# dot and, for each dot, whether its Voronoi cell (clipped to the window) touches the edge of the image (a vertex at less
+# than 1 pixel from a border)
+def delaunay_graph(centroids, width, height):
+	points = _points(centroids)
+	nrow = len(points)
+	tri = Delaunay(points)
+	simplices = tri.simplices
+	edges = np.vstack([simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [2, 0]]])
+	edges = np.unique(np.sort(edges, axis=1), axis=0)
+	counts = np.bincount(edges.ravel(), minlength=nrow)
+	# Voronoi vertices = circumcenters of the triangles (circumcircle of the script)
+	a = points[simplices[:, 0]]
+	b = points[simplices[:, 1]]
+	c = points[simplices[:, 2]]
+	d = 2*((b[:, 0]-a[:, 0])*(c[:, 1]-a[:, 1]) - (b[:, 1]-a[:, 1])*(c[:, 0]-a[:, 0]))
+	a2 = (a*a).sum(axis=1)
+	b2 = (b*b).sum(axis=1)
+	c2 = (c*c).sum(axis=1)
+	ux = (a2*(b[:, 1]-c[:, 1]) + b2*(c[:, 1]-a[:, 1]) + c2*(a[:, 1]-b[:, 1]))/d
+	uy = (a2*(c[:, 0]-b[:, 0]) + b2*(a[:, 0]-c[:, 0]) + c2*(b[:, 0]-a[:, 0]))/d
+	# a corner outside the window is clipped to the border, a corner inside is at the edge if it is closer than 1 pixel
+	cornerAtEdge = (ux <= 1) | (ux >= width-1) | (uy <= 1) | (uy >= height-1)
+	atEdge = np.zeros(nrow, dtype=bool)
+	for k in range(3):
+		np.logical_or.at(atEdge, simplices[:, k], cornerAtEdge)
+	# the cells of the dots of the convex hull are open: clipped to the border
+	atEdge[np.unique(tri.convex_hull)] = True
+	return [edges, counts, atEdge]
+
+
+# spacingAndOrder: [number of bonds, spacing, stdev, sterror, order]. The spacing is the mean length of the Delaunay bonds
+# between the nearest neighbors of the dots whose Voronoi cell is not at the edge (in nm with conversion nm/pixel), and
+# the order parameter is the mean of |psi6| over all the dots
+def spacing_order(centroids, width, height, conversion=1.0, graph=None, neighbors=None):
+	points = _points(centroids)
+	nrow = len(points)
+	if graph is None :
+		graph = delaunay_graph(points, width, height)
+	if neighbors is None :
+		neighbors = nearest_neighbors(points)
+	edges, counts, atEdge = graph
+	idx, dist, angles = neighbors
+	k = idx.shape[1]
+	rows = np.repeat(np.arange(nrow), k).reshape(nrow, k)
+	# isNeighbors: the pair (i, j) is a Delaunay edge
+	keys = np.sort(edges[:, 0].astype(np.int64)*nrow + edges[:, 1])
+	pairKeys = np.minimum(rows, idx).astype(np.int64)*nrow + np.maximum(rows, idx)
+	delaunay = (idx >= 0) & np.isin(pairKeys, keys)
+	used = delaunay & (np.arange(k)[None, :] < counts[:, None]) & ~atEdge[:, None]
+	bonds = used & ((idx > rows) | ((idx < rows) & atEdge[np.maximum(idx, 0)]))
+	nbdist = int(bonds.sum())
+	lengths = dist[bonds]
+	meandist = lengths.sum()/nbdist
+	# the variance of equal lengths can be rounded to a tiny negative value
+	stdev = np.sqrt(max(0.0, (np.dot(lengths, lengths) - nbdist*meandist*meandist)/nbdist))
+	psi = np.where(used, np.exp(6j*np.where(used, angles, 0)), 0).sum(axis=1)
+	inside = ~atEdge
+	phi = (np.abs(psi[inside])/counts[inside]).sum()/nrow
+	meandist *= conversion
+	stdev *= conversion
+	return [nbdist, meandist, stdev, stdev/np.sqrt(nbdist), phi]
+
+
+# Ripley's edge correction weight (edgeWeight) of the dots at (minx, miny) for the radius r
+def _edge_weight(minx, miny, r):
+	dmin = np.minimum(minx, miny)
+	near = r*r <= minx*minx + miny*miny
+	w1 = 1/(1-np.arccos(np.clip(dmin/r, -1, 1))/np.pi)
+	w2 = 1/(1-(np.arccos(np.clip(minx/r, -1, 1))+np.arccos(np.clip(miny/r, -1, 1))+np.pi/2)/(2*np.pi))
+	return np.where(near, w1, w2)
+
+
+# ripleyKCurve: Ripley's K function, or Besag's L function if besag. With rmax > 0, the radii stop at rmax.
+# Return [r, values] (r in nm with conversion nm/pixel)
+def ripley_k(centroids, width, height, besag=True, resolution=1, conversion=1.0, rmax=0, block=1024):
+	points = _points(centroids)
+	nrow = len(points)
+	maxd = int(min(width, height))
+	if rmax > 0 :
+		maxd = int(min(maxd, rmax))
+	maxres = maxd*resolution
+	radii = (np.arange(maxres)+1)/float(resolution)
+	i, j, dij = _pairs(points, radii[-1])
+	# each pair counts for the dot i and for the dot j
+	i, j, dij = [np.concatenate([i, j]), np.concatenate([j, i]), np.concatenate([dij, dij])]
+	minx = np.minimum(points[:, 0], width-points[:, 0])
+	miny = np.minimum(points[:, 1], height-points[:, 1])
+	dmin = np.minimum(minx, miny)
+	bins = np.searchsorted(radii, dij, side="left")
+	inside = dij <= dmin[i]
+	kinside = np.bincount(bins[inside], minlength=maxres)
+	kedge = np.zeros(maxres)
+	edgeDots, edgeRows = np.unique(i[~inside], return_inverse=True)
+	edgeBins = bins[~inside]
+	for start in range(0, len(edgeDots), block):
+		sel = (edgeRows >= start) & (edgeRows < start+block)
+		nblock = min(block, len(edgeDots)-start)
+		counts = np.zeros((nblock, maxres))
+		np.add.at(counts, (edgeRows[sel]-start, edgeBins[sel]), 1)
+		dots = edgeDots[start:start+nblock]
+		weights = _edge_weight(minx[dots][:, None], miny[dots][:, None], radii[None, :])
+		kedge += (np.cumsum(counts, axis=1)*weights).sum(axis=0)
+	kfunc = (np.cumsum(kinside) + kedge)*width*height/float(nrow*(nrow-1))*conversion
+	kfuncX = radii*conversion
+	if besag :
+		kfunc = np.sqrt(kfunc/np.pi) - kfuncX
+	return [kfuncX, kfunc]
+
+
+# Epanechnikov kernel of half-width delta (epanechnikovKernel)
+def _epanechnikov(diff, delta):
+	return np.where(np.abs(diff) < delta, 3*(1-diff*diff/(delta*delta))/(4*delta), 0.0)
+
+
+# Spread the values of the pairs at the distances dij on the radii of the shell |dij - r| < delta: sum of
+# function(dij - r, value) for each radius r. Return the sums and the numbers of pairs of each radius
+def _shell_sums(radii, dij, values, delta, function):
+	first = np.searchsorted(radii, dij-delta, side="right")
+	last = np.searchsorted(radii, dij+delta, side="left")
+	sums = np.zeros(len(radii))
+	counts = np.zeros(len(radii), dtype=np.int64)
+	for offset in range(int((last-first).max(initial=0))):
+		t = first+offset
+		sel = t < last
+		sums += np.bincount(t[sel], weights=function(dij[sel]-radii[t[sel]], values[sel]), minlength=len(radii))
+		counts += np.bincount(t[sel], minlength=len(radii))
+	return [sums, counts]
+
+
+# pairCorrelationCurve: pair correlation function g(r) (Epanechnikov kernel, Ohser-Stoyan edge correction).
+# With rmax > 0, the radii stop at rmax. Return [r, values] (r in nm with conversion nm/pixel)
+def pair_correlation(centroids, width, height, resolution=1, conversion=1.0, rmax=0):
+	points = _points(centroids)
+	nrow = len(points)
+	maxd = int(min(width, height))
+	if rmax > 0 :
+		maxd = int(min(maxd, rmax))
+	invlam = width*height/float(nrow)
+	delta = 0.15*np.sqrt(invlam)
+	radii = np.arange(1, maxd*resolution)/float(resolution)
+	i, j, dij = _pairs(points, radii[-1]+delta)
+	pcfs = _shell_sums(radii, dij, np.ones(len(dij)), delta, lambda diff, v: 2*_epanechnikov(diff, delta))[0]
+	sd = width*height - radii*(2*(width+height)-radii)/np.pi
+	pcfs *= invlam*invlam/(2*np.pi*radii*sd)
+	return [radii*conversion, pcfs]
+
+
+# localPsi6: local bond-orientational order parameter psi6 of each dot (complex), from the angles of its 6 nearest bonds
+def local_psi6(neighbors, nbonds=6):
+	angles = neighbors[2][:, :nbonds]
+	valid = ~np.isnan(angles)
+	return np.where(valid, np.exp(6j*np.where(valid, angles, 0)), 0).sum(axis=1)/valid.sum(axis=1)
+
+
+# orderCorrelationCurve: bond-orientational correlation function g6(r) = <Re(psi6_i.psi6_j*)> over the pairs of the shell
+# |dij - r| < delta. With rmax > 0, the radii stop at rmax. Return [r, values] (r in nm with conversion nm/pixel), without
+# the radii where g6 is not defined or null
+def order_correlation(centroids, width, height, conversion=1.0, rmax=0, neighbors=None):
+	points = _points(centroids)
+	nrow = len(points)
+	if neighbors is None :
+		neighbors = nearest_neighbors(points)
+	maxd = int(min(width, height))
+	if rmax > 0 :
+		maxd = int(min(maxd, rmax))
+	invlam = width*height/float(nrow)
+	delta = 0.15*np.sqrt(invlam)
+	radii = np.arange(1, maxd).astype(float)
+	psi6 = local_psi6(neighbors)
+	i, j, dij = _pairs(points, radii[-1]+delta)
+	corr = (psi6[i]*np.conj(psi6[j])).real
+	sums, counts = _shell_sums(radii, dij, corr, delta, lambda diff, v: v)
+	with np.errstate(invalid="ignore", divide="ignore"):
+		ocf = sums/counts
+	keep = (counts > 0) & (ocf != 0)
+	return [radii[keep]*conversion, ocf[keep]]
+
+
+# Whole analysis of the centroids: spacing and order parameter ("result" = [number of bonds, spacing, stdev, sterror,
+# order]) and the curves [r, values] of the Besag's L ("ripley"), pair correlation ("pcf") and bond-orientational
+# correlation ("ocf") functions (the curves of curves only)
+def analyze(centroids, width, height, conversion=1.0, curves=("ripley", "pcf", "ocf"), rmax=0):
+	points = _points(centroids)
+	neighbors = nearest_neighbors(points)
+	results = {"result": spacing_order(points, width, height, conversion, neighbors=neighbors)}
+	if "ripley" in curves :
+		results["ripley"] = ripley_k(points, width, height, True, 1, conversion, rmax)
+	if "pcf" in curves :
+		results["pcf"] = pair_correlation(points, width, height, 1, conversion, rmax)
+	if "ocf" in curves :
+		results["ocf"] = order_correlation(points, width, height, conversion, rmax, neighbors)
+	return results
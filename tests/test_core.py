@@ -0,0 +1,184 @@
+# Known answers of the analysis core (dot_analyzer.core) on a perfect hexagonal lattice and on a seeded Poisson pattern:
+# the direct (pair by pair) definitions of the estimators of Dot_Analyzer14.py, and the values expected for these
+# patterns (spacing of the lattice, L(r) = 0 and g(r) = 1 for complete spatial randomness, ...)
+
+import numpy as np
+import pytest
+
+import dot_analyzer
+from dot_analyzer.core import _edge_weight, _epanechnikov
+
+a = 20.0
+
+
+# Hexagonal lattice of spacing a in a window of nx x ny dots, with a margin of a around the dots: [centroids, w, h]
+def hexagonal(nx=20, ny=20):
+	points = np.array([[a + i*a + (k % 2)*a/2, a + k*a*np.sqrt(3)/2] for k in range(ny) for i in range(nx)])
+	return [points, (nx+1)*a, (ny-1)*a*np.sqrt(3)/2 + 2*a]
+
+
+# Poisson (uniform) pattern of n dots in a window size x size, seeded: [centroids, w, h]
+def poisson(n=1000, size=700.0, seed=1):
+	rnd = np.random.default_rng(seed)
+	return [rnd.uniform(0, size, (n, 2)), size, size]
+
+
+# Matrix of the distances between all the dots
+def distances(points):
+	diff = points[:, None, :] - points[None, :, :]
+	return np.sqrt((diff*diff).sum(axis=2))
+
+
+def test_nearest_neighbors_match_sorted_distances():
+	points, w, h = poisson(300)
+	idx, dist, angles = dot_analyzer.nearest_neighbors(points)
+	d = distances(points)
+	np.fill_diagonal(d, np.inf)
+	order = np.argsort(d, axis=1)[:, :dot_analyzer.maxNeighbors]
+	np.testing.assert_array_equal(idx, order)
+	np.testing.assert_allclose(dist, np.take_along_axis(d, order, axis=1))
+	np.testing.assert_allclose(angles[:, 0], np.arctan2(points[:, 1]-points[order[:, 0], 1], points[:, 0]-points[order[:, 0], 0]))
+
+
+def test_nearest_neighbors_hexagonal_first_shell():
+	points, w, h = hexagonal()
+	idx, dist, angles = dot_analyzer.nearest_neighbors(points)
+	edges, counts, atEdge = dot_analyzer.delaunay_graph(points, w, h)
+	# the dots of the shifted rows at the left border have a closed cell with 5 Delaunay neighbors only
+	inside = ~atEdge & (counts == 6)
+	assert inside.sum() > 0
+	np.testing.assert_allclose(dist[inside, :6], a)
+	assert (dist[inside, 6] > a*1.5).all()
+
+
+def test_spacing_order_hexagonal():
+	points, w, h = hexagonal()
+	graph = dot_analyzer.delaunay_graph(points, w, h)
+	nbonds, spacing, stdev, sterror, order = dot_analyzer.spacing_order(points, w, h, 2.5, graph)
+	assert nbonds > 0
+	assert spacing == pytest.approx(a*2.5)
+	assert stdev == pytest.approx(0, abs=1e-6)
+	# |psi6| = 1 for every dot whose cell is not at the edge, the dots at the edge count for 0
+	assert order == pytest.approx((~graph[2]).sum()/float(len(points)))
+
+
+def test_spacing_order_poisson_mean_nearest_bond():
+	points, w, h = poisson()
+	nbonds, spacing, stdev, sterror, order = dot_analyzer.spacing_order(points, w, h)
+	# Delaunay bonds between nearest neighbors: longer than the mean nearest-neighbor distance 0.5/sqrt(density)
+	assert 0.5*w/np.sqrt(len(points)) < spacing < 1.5*w/np.sqrt(len(points))
+	assert 0 < order < 1
+
+
+# Ripley's K (or L) of the script by its direct definition: each ordered pair (i, j) closer than r counts 1 if it is
+# inside the edge-free disk of the dot i, else the edge weight of the dot i for the radius r
+def direct_ripley(points, w, h, radii, besag=True):
+	n = len(points)
+	d = distances(points)
+	np.fill_diagonal(d, np.inf)
+	minx = np.minimum(points[:, 0], w-points[:, 0])
+	miny = np.minimum(points[:, 1], h-points[:, 1])
+	dmin = np.minimum(minx, miny)
+	values = []
+	for r in radii :
+		weights = np.where(d <= dmin[:, None], 1.0, _edge_weight(minx, miny, r)[:, None])
+		k = (weights*(d <= r)).sum()*w*h/float(n*(n-1))
+		values.append(np.sqrt(k/np.pi)-r if besag else k)
+	return np.array(values)
+
+
+def test_ripley_k_matches_direct_definition():
+	points, w, h = poisson(200, 300.0)
+	r, values = dot_analyzer.ripley_k(points, w, h, besag=False, rmax=60)
+	np.testing.assert_allclose(r, np.arange(1, 61))
+	np.testing.assert_allclose(values, direct_ripley(points, w, h, r, besag=False), rtol=1e-9, atol=1e-9)
+
+
+def test_ripley_l_poisson_close_to_zero():
+	points, w, h = poisson()
+	r, values = dot_analyzer.ripley_k(points, w, h, rmax=100)
+	assert np.abs(values[r >= 20]).max() < 3.0
+
+
+def test_ripley_l_hexagonal_no_pair_below_spacing():
+	points, w, h = hexagonal()
+	r, values = dot_analyzer.ripley_k(points, w, h, rmax=40)
+	# no pair closer than a: K(r) = 0 and L(r) = -r
+	np.testing.assert_allclose(values[r < a], -r[r < a])
+
+
+# g(r) of the script by its direct definition: Epanechnikov kernel of half-width 0.15/sqrt(density) over the ordered
+# pairs, Ohser-Stoyan edge correction
+def direct_pair_correlation(points, w, h, radii):
+	n = len(points)
+	invlam = w*h/float(n)
+	delta = 0.15*np.sqrt(invlam)
+	d = distances(points)
+	np.fill_diagonal(d, np.inf)
+	values = []
+	for r in radii :
+		sd = w*h - r*(2*(w+h)-r)/np.pi
+		values.append(_epanechnikov(d-r, delta).sum()*invlam*invlam/(2*np.pi*r*sd))
+	return np.array(values)
+
+
+def test_pair_correlation_matches_direct_definition():
+	points, w, h = poisson(200, 300.0)
+	r, values = dot_analyzer.pair_correlation(points, w, h, rmax=60)
+	np.testing.assert_allclose(r, np.arange(1, 60))
+	np.testing.assert_allclose(values, direct_pair_correlation(points, w, h, r), rtol=1e-9, atol=1e-12)
+
+
+def test_pair_correlation_poisson_close_to_one():
+	points, w, h = poisson()
+	r, values = dot_analyzer.pair_correlation(points, w, h, rmax=150)
+	assert values[(r >= 30) & (r <= 150)].mean() == pytest.approx(1.0, abs=0.1)
+
+
+def test_pair_correlation_hexagonal_peak_at_spacing():
+	points, w, h = hexagonal()
+	r, values = dot_analyzer.pair_correlation(points, w, h, rmax=60)
+	assert r[np.argmax(values)] == pytest.approx(a, abs=1)
+
+
+# g6(r) of the script by its direct definition: mean of Re(psi6_i.psi6_j*) over the pairs of the shell |dij - r| < delta
+def direct_order_correlation(points, w, h, radii, neighbors):
+	n = len(points)
+	delta = 0.15*np.sqrt(w*h/float(n))
+	psi6 = dot_analyzer.local_psi6(neighbors)
+	corr = (psi6[:, None]*np.conj(psi6[None, :])).real
+	d = distances(points)
+	upper = np.triu(np.ones((n, n), dtype=bool), 1)
+	values = []
+	for r in radii :
+		shell = upper & (np.abs(d-r) < delta)
+		values.append(corr[shell].mean() if shell.any() else np.nan)
+	return np.array(values)
+
+
+def test_order_correlation_matches_direct_definition():
+	points, w, h = poisson(200, 300.0)
+	neighbors = dot_analyzer.nearest_neighbors(points)
+	r, values = dot_analyzer.order_correlation(points, w, h, rmax=60, neighbors=neighbors)
+	expected = direct_order_correlation(points, w, h, r, neighbors)
+	np.testing.assert_allclose(values, expected, rtol=1e-9, atol=1e-12)
+
+
+def test_order_correlation_hexagonal_first_shell():
+	points, w, h = hexagonal()
+	r, values = dot_analyzer.order_correlation(points, w, h, rmax=60)
+	# psi6 = 1 for all the dots but the edge ones (fewer than 6 bonds in the first shell)
+	assert values[np.argmin(np.abs(r-a))] > 0.8
+
+
+def test_order_correlation_poisson_uncorrelated():
+	points, w, h = poisson()
+	r, values = dot_analyzer.order_correlation(points, w, h, rmax=150)
+	assert np.abs(values[r >= 60].mean()) < 0.05
+
+
+def test_analyze_returns_all_curves():
+	points, w, h = poisson(300, 400.0)
+	results = dot_analyzer.analyze(points, w, h, 2.0, rmax=50)
+	assert sorted(results) == ["ocf", "pcf", "result", "ripley"]
+	assert results["result"][1] == pytest.approx(dot_analyzer.spacing_order(points, w, h, 2.0)[1])